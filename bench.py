@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+
+# Headless benchmarks for couchmode, e.g.:
+#   ./bench.py raster --size 96 --count 200
+#   ./bench.py startup load render --apps 300 --json results.json
+#   ./bench.py present scale --resolution 3840 2160
+#
+# Everything runs against a synthetic tree (desktop files, an icon theme,
+# a background and a config) in a temporary directory, with its own cache.
+
+import os
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# before couchmode and xdg read them
+ROOT = tempfile.mkdtemp(prefix="couchmode-bench-")
+os.environ["XDG_CACHE_HOME"] = os.path.join(ROOT, "cache")
+os.environ["XDG_DATA_HOME"] = os.path.join(ROOT, "home")
+os.environ["XDG_DATA_DIRS"] = os.path.join(ROOT, "share")
+
+import yaml
+import couchmode
+from couchmode import pygame
+from PIL import Image, ImageDraw
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="48" height="48">
+<circle cx="24" cy="24" r="20" fill="#3a7" stroke="#123" stroke-width="3"/>
+<rect x="14" y="14" width="20" height="20" rx="4" fill="#fc3" opacity="0.7"/>
+</svg>
+"""
+
+
+def draw_svg(fn, sz):
+    # cairo only here, so the benchmarks that don't rasterize run without it
+    import cairo
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *sz)
+    ctx = cairo.Context(surface)
+    svg = couchmode.load_rsvg().Handle.new_from_file(fn)
+    dim = svg.get_dimensions()
+    scale = sz[0] / dim.width
+    ctx.scale(scale, scale)
+    svg.render_cairo(ctx)
+    return surface
+
+
+# the conversion chains before the zero-copy path, kept for comparison;
+# each returns the surface and the number of bytes copied on the way,
+# summed over the buffers it actually produced
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+def image_bytes(im):
+    return im.width * im.height * len(im.getbands())
+
+
+def svg_legacy(fn, sz):
+    surface = draw_svg(fn, sz)
+    data = surface.get_data().tobytes()
+    im = Image.frombuffer("RGBA", tuple(sz), data, "raw", "BGRA", 0, 0)
+    buf = im.tobytes()
+    loaded = pygame.image.fromstring(buf, tuple(sz), "RGBA")
+    icon = loaded.convert_alpha()
+    # tobytes, BGRA decode, tobytes, fromstring, convert_alpha
+    return icon, len(data) + image_bytes(im) + len(buf) + surface_bytes(loaded) + surface_bytes(icon)
+
+
+def svg_current(fn, sz):
+    icon = couchmode.buffer_to_surface(couchmode.render_svg(fn, sz), sz)
+    # convert_alpha, frombuffer wraps cairo's data
+    return icon, surface_bytes(icon)
+
+
+def png_legacy(fn, sz):
+    im = Image.open(fn).convert("RGBA")
+    im = im.resize(tuple(sz), Image.LANCZOS)
+    buf = im.tobytes()
+    loaded = pygame.image.fromstring(buf, tuple(sz), "RGBA")
+    icon = loaded.convert_alpha()
+    # tobytes, fromstring, convert_alpha
+    return icon, len(buf) + surface_bytes(loaded) + surface_bytes(icon)
+
+
+def png_current(fn, sz):
+    buf = couchmode.render_png(fn, sz)
+    icon = couchmode.buffer_to_surface(buf, sz)
+    # tobytes, convert_alpha
+    return icon, len(buf) + surface_bytes(icon)
+
+
+def make_tree(args):
+    # n desktop files whose icons alternate between SVG and PNG in a theme
+    share = os.path.join(ROOT, "share")
+    appdir = os.path.join(share, "applications")
+    theme = os.path.join(share, "icons", "BenchTheme")
+    svgdir = os.path.join(theme, "scalable", "apps")
+    pngdir = os.path.join(theme, "48x48", "apps")
+    for d in (appdir, svgdir, pngdir):
+        os.makedirs(d, exist_ok=True)
+    with open(os.path.join(theme, "index.theme"), "w") as f:
+        f.write(
+            "[Icon Theme]\nName=BenchTheme\nDirectories=scalable/apps,48x48/apps\n\n"
+            "[scalable/apps]\nSize=48\nMinSize=8\nMaxSize=512\nType=Scalable\n\n"
+            "[48x48/apps]\nSize=48\nType=Fixed\n"
+        )
+    stems = []
+    for i in range(args.apps):
+        stem = "bench-app-{}".format(i)
+        stems.append(stem)
+        color = "#{:06x}".format((i * 2654435761) & 0xFFFFFF)
+        if i % 2:
+            im = Image.new("RGBA", (48, 48))
+            ImageDraw.Draw(im).ellipse((4, 4, 44, 44), fill=color, outline="black")
+            im.save(os.path.join(pngdir, stem + ".png"))
+        else:
+            with open(os.path.join(svgdir, stem + ".svg"), "w") as f:
+                f.write(SVG.replace("#3a7", color))
+        with open(os.path.join(appdir, stem + ".desktop"), "w") as f:
+            f.write(
+                "[Desktop Entry]\nType=Application\nName=Bench App {0}\n"
+                "GenericName=Benchmark {0}\nKeywords=bench;test{0};\n"
+                "Exec=true %U\nIcon={1}\n".format(i, stem)
+            )
+
+    background = os.path.join(ROOT, "background.jpg")
+    Image.effect_noise((1920, 1080), 64).convert("RGB").save(background)
+    config = os.path.join(ROOT, "config.yaml")
+    with open(config, "w") as f:
+        yaml.safe_dump(
+            {
+                "apps": stems,
+                "appdirs": [appdir],
+                "theme": "BenchTheme",
+                "resolution": list(args.resolution),
+                "background": background,
+            },
+            f,
+        )
+    return config, stems
+
+
+def clear_cache():
+    shutil.rmtree(couchmode.CACHE_DIR, ignore_errors=True)
+
+
+def homescreen(args, config=None):
+    # no cec-client, the empty log is a CEC source that never sends anything
+    h = couchmode.Homescreen(cec_log=os.devnull, config=config or args.config)
+    h.done = False
+    h.last_date = None
+    h.date = None
+    return h
+
+
+def settle(h):
+    # run frames until every queued icon has been uploaded
+    while h.loading:
+        events = [pygame.event.wait(100)] + pygame.event.get()
+        h.update(0, events)
+        h.render()
+
+
+def stats(times):
+    times = sorted(times)
+    return {
+        "mean_ms": sum(times) / len(times) * 1000,
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p95_ms": times[min(len(times) - 1, len(times) * 95 // 100)] * 1000,
+        "max_ms": times[-1] * 1000,
+    }
+
+
+def bench_startup(args):
+    results = {}
+    for name in ("cold", "warm"):
+        if name == "cold":
+            clear_cache()
+        start = time.perf_counter()
+        h = homescreen(args)
+        init = time.perf_counter() - start
+        h.update(0)
+        h.render()
+        first = time.perf_counter() - start
+        settle(h)
+        loaded = time.perf_counter() - start
+        while h.deferred:
+            h.run_deferred()
+        h.close()
+        results[name] = r = {
+            "init_ms": init * 1000,
+            "first_frame_ms": first * 1000,
+            "icons_loaded_ms": loaded * 1000,
+            "stages_ms": {stage: t * 1000 for stage, t in h.stages},
+        }
+        print(
+            "{:5} init {:8.1f} ms, first frame {:8.1f} ms, icons {:8.1f} ms".format(
+                name, r["init_ms"], r["first_frame_ms"], r["icons_loaded_ms"]
+            )
+        )
+    return results
+
+
+def bench_load(args):
+    h = homescreen(args)
+    settle(h)
+    sz = h.icon_sz
+    fns = [h.icon_index.lookup(stem, sz[0]) for stem in args.stems]
+    svgs = [fn for fn in fns if fn.endswith(".svg")]
+    entries = [h.entry(i) for i in range(len(h.my_apps))]
+
+    results = {}
+    for name in ("cold", "warm"):
+        if name == "cold":
+            h.icon_cache.clear()
+        start = time.perf_counter()
+        for fn in svgs:
+            h.load_svg(fn, sz)
+        elapsed = time.perf_counter() - start
+        results["load_svg_" + name] = {
+            "icons": len(svgs),
+            "ms_per_icon": elapsed / len(svgs) * 1000,
+        }
+
+        if name == "cold":
+            h.icon_cache.clear()
+        start = time.perf_counter()
+        for entry in entries:
+            h.icons.drop(entry)
+            h.load(entry)
+        settle(h)
+        elapsed = time.perf_counter() - start
+        results["load_" + name] = {
+            "icons": len(entries),
+            "icons_per_s": len(entries) / elapsed,
+        }
+    h.close()
+    for name, r in results.items():
+        print(name, json.dumps(r))
+    return results
+
+
+def bench_render(args):
+    h = homescreen(args)
+    h.update(0)
+    h.render()
+    settle(h)
+
+    def frames(step):
+        times = []
+        for i in range(args.frames):
+            start = time.perf_counter()
+            step(i)
+            h.render()
+            times.append(time.perf_counter() - start)
+        return stats(times)
+
+    results = {
+        "full": frames(lambda i: h.invalidate()),
+        "move": frames(lambda i: h.move((i % 2, 1 - i % 2, 0, 0))),
+        "idle": frames(lambda i: None),
+    }
+    h.close()
+    for name, r in results.items():
+        print("{:5} {}".format(name, json.dumps(r)))
+    return results
+
+
+def bench_scale(args):
+    # the render benchmark and the memory report at each render_scale
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+    results = {}
+    for scale in (0.5, 0.75, 1.0):
+        config = os.path.join(ROOT, "config-{}.yaml".format(scale))
+        with open(config, "w") as f:
+            yaml.safe_dump(dict(cfg, render_scale=scale), f)
+        h = homescreen(args, config)
+        h.update(0)
+        h.render()
+        settle(h)
+        r = {}
+        for name, step in (
+            ("full", lambda i: h.invalidate()),
+            ("move", lambda i: h.move((i % 2, 1 - i % 2, 0, 0))),
+        ):
+            times = []
+            for i in range(args.frames):
+                start = time.perf_counter()
+                step(i)
+                h.render()
+                times.append(time.perf_counter() - start)
+            r[name] = stats(times)
+        r["memory_kb"] = {name: n // 1024 for name, n in h.memory()}
+        h.close()
+        results[str(scale)] = r
+        print(
+            "{:4} {}x{}: full p50 {:7.2f} ms, move p50 {:7.2f} ms, {} KB".format(
+                scale,
+                h.res[0],
+                h.res[1],
+                r["full"]["p50_ms"],
+                r["move"]["p50_ms"],
+                sum(r["memory_kb"].values()),
+            )
+        )
+    return results
+
+
+def bench_present(args):
+    # composing one page layer into the render target and presenting it, at
+    # each render_scale and upscale filter; pygame only, no Homescreen
+    background = pygame.image.load(os.path.join(ROOT, "background.jpg"))
+    results = {}
+    for scale, smooth in ((0.5, False), (0.5, True), (0.75, False), (0.75, True), (1.0, False)):
+        out = couchmode.ScaledDisplay(couchmode.ivec2(*args.resolution), scale, 0, smooth)
+        out.set_mode()
+        res = out.render_res
+        layer = pygame.transform.scale(background, tuple(res)).convert()
+        w, h = res
+        tiles = [pygame.Rect(w // 4, h // 3, w // 10, h // 5), pygame.Rect(w // 2, h // 3, w // 10, h // 5)]
+
+        def frames(rects):
+            times = []
+            for i in range(args.frames):
+                start = time.perf_counter()
+                for rect in rects:
+                    out.screen.blit(layer, rect, rect)
+                pygame.display.update(out.upscale(rects))
+                times.append(time.perf_counter() - start)
+            return stats(times)
+
+        # background, three page layers and the render target
+        surfaces = w * h * layer.get_bytesize() * (4 if scale < 1 else 3)
+        surfaces += out.display.get_width() * out.display.get_height() * out.display.get_bytesize()
+        name = "{}{}".format(scale, " smooth" if smooth else "")
+        results[name] = r = {
+            "full": frames([out.screen.get_rect()]),
+            "move": frames(tiles),
+            "surfaces_mb": surfaces / 1e6,
+        }
+        print(
+            "{:12} full p50 {:6.2f} ms, move p50 {:6.2f} ms, {:5.1f} MB".format(
+                name, r["full"]["p50_ms"], r["move"]["p50_ms"], r["surfaces_mb"]
+            )
+        )
+    pygame.display.set_mode((1, 1))
+    return results
+
+
+def bench_write(args):
+    h = homescreen(args)
+    pos = couchmode.ivec2(h.res[0] // 2, h.res[1] // 2)
+    results = {}
+    for name, text in (("cached", lambda i: "Bench App"), ("uncached", "Bench {}".format)):
+        start = time.perf_counter()
+        for i in range(args.count):
+            h.write(h.screen, text(i), pos)
+        elapsed = time.perf_counter() - start
+        results[name] = {"us_per_call": elapsed / args.count * 1e6}
+        print("{:8} {:8.1f} us/call".format(name, results[name]["us_per_call"]))
+    h.close()
+    return results
+
+
+def bench_latency(args):
+    # synthetic presses from each source, left and right in turn, handled by
+    # the same wait/update/render steps as Homescreen.run()
+    h = homescreen(args)
+    h.update(0)
+    h.render()
+    settle(h)
+
+    def cec(i):
+        key = b"right" if i % 2 else b"left"
+        h.cec.feed(b"key pressed: " + key + b" (3)\n")
+        h.cec.feed(b"key released: " + key + b" (3)\n")
+
+    def key(i):
+        key = pygame.K_RIGHT if i % 2 else pygame.K_LEFT
+        pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=key, unicode=""))
+
+    def joy(i):
+        for value in (1.0 if i % 2 else -1.0, 0.0):
+            pygame.event.post(
+                pygame.event.Event(pygame.JOYAXISMOTION, joy=0, instance_id=0, axis=0, value=value)
+            )
+
+    results = {}
+    for source, inject in (("cec", cec), ("key", key), ("joy", joy)):
+        h.move((1, 0, 0, 0))
+        h.render()
+        for i in range(args.frames):
+            inject(i + 1)
+            events = [pygame.event.wait(100)] + pygame.event.get()
+            h.update(0, events)
+            h.render()
+        results[source] = stats([ms / 1000 for ms in h.latency.recent[source]])
+        print("{:5} {}".format(source, json.dumps(results[source])))
+    print(h.latency.dump())
+    h.close()
+    return results
+
+
+def measure(fn, path, sz, count):
+    copied = 0
+    start = time.perf_counter()
+    for i in range(count):
+        icon, n = fn(path, sz)
+        copied += n
+    elapsed = time.perf_counter() - start
+    return {
+        "ms_per_icon": elapsed / count * 1000,
+        "bytes_copied_per_icon": copied // count,
+    }
+
+
+def bench_raster(args):
+    sz = (args.size, args.size)
+    svg = os.path.join(ROOT, "icon.svg")
+    with open(svg, "w") as f:
+        f.write(SVG)
+    png = os.path.join(ROOT, "icon.png")
+    draw_svg(svg, (256, 256)).write_to_png(png)
+
+    results = {}
+    for name, fn, path in (
+        ("svg_legacy", svg_legacy, svg),
+        ("svg_current", svg_current, svg),
+        ("png_legacy", png_legacy, png),
+        ("png_current", png_current, png),
+    ):
+        results[name] = r = measure(fn, path, sz, args.count)
+        print(
+            "{:12} {:8.3f} ms/icon {:10} bytes copied/icon".format(
+                name, r["ms_per_icon"], r["bytes_copied_per_icon"]
+            )
+        )
+    return results
+
+
+BENCHMARKS = {
+    "raster": bench_raster,
+    "startup": bench_startup,
+    "load": bench_load,
+    "render": bench_render,
+    "scale": bench_scale,
+    "present": bench_present,
+    "write": bench_write,
+    "latency": bench_latency,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Couch Mode benchmarks")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("--size", type=int, default=96, help="icon size in pixels")
+    parser.add_argument("--count", type=int, default=200, help="icons per run")
+    parser.add_argument("--apps", type=int, default=100, help="synthetic apps")
+    parser.add_argument("--frames", type=int, default=200, help="frames per run")
+    parser.add_argument(
+        "--resolution", type=int, nargs=2, default=(1920, 1080), metavar=("W", "H")
+    )
+    parser.add_argument("--json", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep " + ROOT)
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    args.config, args.stems = make_tree(args)
+
+    results = {
+        "version": 1,
+        "args": {k: v for k, v in vars(args).items() if k not in ("config", "stems")},
+    }
+    try:
+        for name in args.benchmarks:
+            print("#", name)
+            results[name] = BENCHMARKS[name](args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(ROOT, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -2,6 +2,9 @@
 
 import sys, os
 import subprocess
+import re
+import queue
+import shlex
 from glm import ivec2, vec2, vec3, vec4
 with open(os.devnull, 'w') as devnull:
     # suppress pygame messages
@@ -9,52 +12,162 @@ with open(os.devnull, 'w') as devnull:
     sys.stdout = devnull
     import pygame
     sys.stdout = stdout
-from dataclasses import dataclass
-import xdg.DesktopEntry
-import xdg.IconTheme
 import random
-from PIL import Image, ImageFilter
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import datetime
-import gi
-from collections import defaultdict
-
-gi.require_version("Rsvg", "2.0")
-from gi.repository import Rsvg as rsvg
-import cairo
+from collections import defaultdict, OrderedDict, deque, namedtuple
+import argparse
+import contextlib
+import bisect
+import signal
+import hashlib
+import shutil
+import struct
+import zlib
+import json
 import math
+from fractions import Fraction
+
+# xdg, PIL, cairo and gi/Rsvg are imported where they are first needed, so the
+# window and the last frame can be up before they load
 
 BLACK = (0, 0, 0)
 LIGHT_GRAY = pygame.Color("lightgray")
 DARK_GRAY = pygame.Color("darkgray")
 WHITE = (255, 255, 255)
 
+# custom events that wake the idle loop
+CEC_EVENT = pygame.USEREVENT + 1
+CLOCK_EVENT = pygame.USEREVENT + 2
+LOAD_EVENT = pygame.USEREVENT + 3
+BACKGROUND_EVENT = pygame.USEREVENT + 4
+LAUNCH_EVENT = pygame.USEREVENT + 5
+DUMP_EVENT = pygame.USEREVENT + 6
+CONFIG_EVENT = pygame.USEREVENT + 7
+TRAY_EVENT = pygame.USEREVENT + 8
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "couchmode"
+)
+
+
+def wake(event_type, **attrs):
+    # safe from any thread, dropped while the display is down
+    try:
+        pygame.event.post(pygame.event.Event(event_type, **attrs))
+    except pygame.error:
+        pass
+
+
+CecEvent = namedtuple("CecEvent", "key kind time")
+
 
 class CEC(threading.Thread):
+    # reads cec-client output (or replays a captured log) into timestamped
+    # key events, handed to the render thread through a queue
+    KEY = re.compile(rb"key (pressed|released): (.+?) \(")
+    POWER = re.compile(rb"power status: (\S+)")
+    STAMP = re.compile(rb"^\w+:\s+\[\s*(\d+)\]")
+    # a held key not seen again for this long was released, its release
+    # line lost; the next press is a press again
+    HOLD_TIMEOUT = 1.0
+
+    def __init__(self, command="cec-client", log=None):
+        super().__init__(daemon=True)
+        self.command = command
+        self.log = log
+        self.proc = None
+        self.events = queue.SimpleQueue()
+        self.held = {}  # key -> last pressed, reader thread only
+        self.latency = deque(maxlen=256)
+        self.stopped = threading.Event()
+        self.power = None  # TV power status, as last reported
+
     def run(self):
-        self.buttons = set()
-        self.proc = subprocess.Popen(
-            "cec-client", stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        self.held.clear()
+        if self.log:
+            self.replay()
+            return
+        try:
+            self.proc = subprocess.Popen(
+                shlex.split(self.command), stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+        except OSError as e:
+            print("CEC:", e)
+            return
+        for line in iter(self.proc.stdout.readline, b""):
+            self.feed(line)
+
+    def replay(self):
+        # keep the timing of the capture, cec-client stamps lines in ms
+        start = time.perf_counter()
+        with open(self.log, "rb") as f:
+            for line in f:
+                m = self.STAMP.match(line)
+                if m:
+                    delay = int(m.group(1)) / 1000 - (time.perf_counter() - start)
+                    if delay > 0 and self.stopped.wait(delay):
+                        return
+                if self.stopped.is_set():
+                    return
+                self.feed(line)
+
+    def parse(self, line):
+        m = self.KEY.search(line)
+        if not m:
+            return None
+        key = m.group(2).decode(errors="replace")
+        now = time.perf_counter()
+        if m.group(1) == b"pressed":
+            held = self.held.get(key)
+            kind = "repeat" if held and now - held < self.HOLD_TIMEOUT else "press"
+            self.held[key] = now
+        else:
+            kind = "release"
+            self.held.pop(key, None)
+        return CecEvent(key, kind, now)
+
+    def feed(self, line):
+        ev = self.parse(line)
+        if ev:
+            self.events.put(ev)
+            wake(CEC_EVENT)
+            return
+        m = self.POWER.search(line)
+        if m:
+            self.power = m.group(1).decode(errors="replace")
+
+    # render thread
+    def next(self):
+        try:
+            return self.events.get_nowait()
+        except queue.Empty:
+            return None
+
+    def handled(self, ev):
+        self.latency.append(time.perf_counter() - ev.time)
+
+    def stats(self):
+        if not self.latency:
+            return "CEC: no events"
+        return "CEC: {} events, latency avg {:.2f} ms, max {:.2f} ms".format(
+            len(self.latency),
+            sum(self.latency) / len(self.latency) * 1000,
+            max(self.latency) * 1000,
         )
-        while self.proc.poll() is None:
-            line = self.proc.stdout.readline()
-            if b"key pressed" in line:
-                line = line[line.find(b"key pressed: ") + len("key pressed: ") :]
-                line = line[: line.find(b" ")]
-                # print(line)
-                self.buttons.add(line)
-            elif b"key released" in line:
-                line = line[line.find(b"key released: ") + len("key released: ") :]
-                line = line[: line.find(b" ")]
-                # print(b'- ' + line)
-                if line in self.buttons:
-                    self.buttons.remove(line)
 
     def write(self, msg):
-        self.proc.stdin.write(msg + "\n")
+        try:
+            self.proc.stdin.write(msg.encode() + b"\n")
+            self.proc.stdin.flush()
+        except (AttributeError, OSError):
+            pass
 
     def stop(self):
+        self.stopped.set()
         try:
             self.proc.terminate()
         except:
@@ -65,56 +178,1404 @@ class CEC(threading.Thread):
             pass
 
 
-@dataclass
-class Entry:
-    name: str
-    icon_fn: str
-    run: str
-    entry: xdg.DesktopEntry = None
-    icon: any = None
+class Launcher:
+    # runs an app in its own process group and posts LAUNCH_EVENT when it
+    # exits, so the loop never blocks on it
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.args = [arg for arg in shlex.split(cmd) if not arg.startswith("%")]
+        self.start = time.perf_counter()
+        self.proc = subprocess.Popen(self.args, start_new_session=True)
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self):
+        code = self.proc.wait()
+        wake(LAUNCH_EVENT, code=code)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class TrayProvider(threading.Thread):
+    # a status polled on its own thread at its own interval; the render thread
+    # only reads self.state and draws the pre-rasterized icon for it.
+    # backend() returns the raw status (command output, a value), parse()
+    # turns it into one of the states in icons, None hides it
+    interval = 5
+    command = None
+    icons = {}
+
+    def __init__(self, backend=None):
+        super().__init__(daemon=True)
+        self.backend = backend or self.probe
+        self.state = None
+        self.stopped = threading.Event()
+
+    def probe(self):
+        return subprocess.run(
+            self.command, capture_output=True, text=True, timeout=self.interval
+        ).stdout
+
+    def poll(self):
+        try:
+            state = self.parse(self.backend())
+        except (OSError, ValueError, subprocess.SubprocessError):
+            state = None
+        if state != self.state:
+            self.state = state
+            wake(TRAY_EVENT)
 
+    def run(self):
+        while True:
+            self.poll()
+            if self.stopped.wait(self.interval):
+                return
 
-class Homescreen:
-    def __init__(self):
-        with open("config.yaml", "r") as cfg:
-            self.cfg = yaml.safe_load(cfg)
+    def stop(self):
+        self.stopped.set()
+
+
+class VolumeProvider(TrayProvider):
+    interval = 2
+    command = ["amixer", "get", "Master"]
+    icons = {
+        "muted": "audio-volume-muted",
+        "low": "audio-volume-low",
+        "medium": "audio-volume-medium",
+        "high": "audio-volume-high",
+    }
+
+    def parse(self, out):
+        m = re.search(r"\[(\d+)%\](.*)", out)
+        if not m:
+            return None
+        volume = int(m.group(1))
+        if volume == 0 or "[off]" in m.group(2):
+            return "muted"
+        return "low" if volume < 34 else "medium" if volume < 67 else "high"
+
+
+class NetworkProvider(TrayProvider):
+    interval = 10
+    icons = {
+        "offline": "nm-no-connection",
+        "wired": "nm-device-wired",
+        "signal-00": "nm-signal-00",
+        "signal-25": "nm-signal-25",
+        "signal-50": "nm-signal-50",
+        "signal-75": "nm-signal-75",
+        "signal-100": "nm-signal-100",
+    }
+
+    def probe(self):
+        # device states, then the signal of the active wifi network
+        out = ""
+        for command in (
+            ["nmcli", "-t", "-f", "TYPE,STATE", "dev"],
+            ["nmcli", "-t", "-f", "ACTIVE,SIGNAL", "dev", "wifi"],
+        ):
+            out += subprocess.run(
+                command, capture_output=True, text=True, timeout=self.interval
+            ).stdout
+        return out
+
+    def parse(self, out):
+        lines = out.splitlines()
+        if "ethernet:connected" in lines:
+            return "wired"
+        for line in lines:
+            if line.startswith("yes:"):
+                strength = int(line[4:])
+                return "signal-{:02}".format(min(100, (strength + 12) // 25 * 25))
+        return "offline" if lines else None
+
+
+class CecPowerProvider(TrayProvider):
+    # asks cec-client for the TV's power status, the answer comes back
+    # through the CEC reader and is picked up on the next poll
+    interval = 10
+    icons = {"on": "video-display", "standby": "system-suspend"}
+
+    def __init__(self, cec, backend=None):
+        self.cec = cec
+        super().__init__(backend)
+
+    def probe(self):
+        self.cec.write("pow 0")
+        return self.cec.power
+
+    def parse(self, power):
+        return power if power in self.icons else None
+
+
+class BatteryProvider(TrayProvider):
+    # lowest charge of any device battery (gamepads, remotes), hidden when
+    # nothing is connected
+    interval = 30
+    path = "/sys/class/power_supply"
+    icons = {
+        "caution": "battery-caution",
+        "low": "battery-low",
+        "good": "battery-good",
+        "full": "battery-full",
+    }
+
+    def probe(self):
+        levels = []
+        for name in os.listdir(self.path):
+            supply = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(supply, "scope")) as f:
+                    if f.read().strip() != "Device":
+                        continue
+                with open(os.path.join(supply, "capacity")) as f:
+                    levels.append(int(f.read()))
+            except (OSError, ValueError):
+                continue
+        return levels
+
+    def parse(self, levels):
+        if not levels:
+            return None
+        level = min(levels)
+        return "caution" if level < 10 else "low" if level < 30 else "good" if level < 80 else "full"
+
+
+TRAY_PROVIDERS = {
+    "volume": VolumeProvider,
+    "network": NetworkProvider,
+    "cec": CecPowerProvider,
+    "battery": BatteryProvider,
+}
+
+
+class RasterCache:
+    # rasterized images, stored as zlib-compressed RGBA/RGB with a small
+    # header, keyed by source path, mtime/size, target size and an extra
+    # parameter (icon theme, blur radius)
+    MAGIC = b"CMI2"
+    HEADER = struct.Struct("<4sHH")
+
+    def __init__(self, path=None, max_bytes=32 * 1024 * 1024, channels=4):
+        self.path = path or os.path.join(CACHE_DIR, "icons")
+        self.max_bytes = max_bytes
+        self.channels = channels
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        # shared by the icon loader threads
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, fn, sz, extra):
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        key = "\0".join(
+            map(str, (fn, st.st_mtime_ns, st.st_size, sz[0], sz[1], extra))
+        )
+        return hashlib.sha1(key.encode()).hexdigest()
 
+    def get(self, key, sz):
+        if key is None:
+            return None
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, w, h = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC or (w, h) != tuple(sz):
+                raise ValueError(path)
+            buf = zlib.decompress(data[self.HEADER.size :])
+            if len(buf) != w * h * self.channels:
+                raise ValueError(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError, struct.error, zlib.error):
+            # corrupt entry, rebuild it
+            with self.lock:
+                self.misses += 1
+            self.remove(key)
+            return None
+        # mtime doubles as the LRU timestamp
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return buf
+
+    def put(self, key, sz, buf):
+        if key is None:
+            return
+        data = self.HEADER.pack(self.MAGIC, *sz) + zlib.compress(buf, 1)
+        path = os.path.join(self.path, key)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Icon cache:", e)
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum(e.stat().st_size for e in os.scandir(self.path))
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            pass
+        with self.lock:
+            self.size = None
+
+    def evict(self):
+        entries = sorted(os.scandir(self.path), key=lambda e: e.stat().st_mtime)
+        self.size = sum(e.stat().st_size for e in entries)
+        # drop least recently used down to 3/4 of the cap
+        for e in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            self.size -= e.stat().st_size
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
 
-        self.fullscreen = self.cfg.get("fullscreen", False)
-        self.theme = self.cfg.get("theme", None)
-        self.browser = self.cfg.get("browser", None)
-        self.res = ivec2(*self.cfg.get("resolution", (1920, 1080)))
-        
-        self.icon_sz = ivec2(self.cfg.get("icon_size", ivec2(self.res[0]/12.3)))
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            self.size = 0
+
+
+class TextCache:
+    # rendered strings with their shadow pre-composited, LRU within a byte budget
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.fonts = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def font(self, size):
+        try:
+            return self.fonts[size]
+        except KeyError:
+            font = self.fonts[size] = pygame.font.Font(
+                pygame.font.get_default_font(), size
+            )
+            return font
 
-        self.cec = CEC()
-        self.cec.start()
+    def get(self, text, size, color, shadow, shadow_offset, underline):
+        key = (text, tuple(color), tuple(shadow), tuple(shadow_offset), underline, size)
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+
+        font = self.font(size)
+        if underline:
+            font.set_underline(True)
+        shadowbuf = font.render(text, True, shadow)
+        textbuf = font.render(text, True, color)
+        if underline:
+            font.set_underline(False)
+
+        # text sits at (ox, oy) inside the composite, shadow at the offset from it
+        w, h = textbuf.get_size()
+        dx, dy = shadow_offset
+        ox, oy = max(0, -dx), max(0, -dy)
+        surface = pygame.Surface((w + abs(dx), h + abs(dy)), pygame.SRCALPHA)
+        surface.blit(shadowbuf, (ox + dx, oy + dy))
+        surface.blit(textbuf, (ox, oy))
+        entry = surface, ivec2(ox, oy), w
+
+        self.entries[key] = entry
+        self.bytes += surface.get_width() * surface.get_height() * 4
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (old, _, _) = self.entries.popitem(last=False)
+            self.bytes -= old.get_width() * old.get_height() * 4
+            self.evictions += 1
+        return entry
+
+    def stats(self):
+        return "text cache: {} hits, {} misses, {} evictions, {} entries, {} KB".format(
+            self.hits, self.misses, self.evictions, len(self.entries), self.bytes // 1024
+        )
+
+
+class Profiler:
+    # per-frame timings of Homescreen phases, taken by wrapping the instance's
+    # methods while enabled, so a disabled profiler costs nothing
+    PHASES = {
+        "events": "handle_events",
+        "cec": "handle_cec",
+        "icons": "poll_icons",
+        "animate": "animate",
+        "layers": "draw_page",
+        "background": "draw_background",
+        "tiles": "draw_tile",
+        "text": "write",
+        "compose": "draw",
+        "flip": "present",
+    }
+    # each call of these is one blit (compose: the layer for a damage rect)
+    BLITS = ("background", "tiles", "text", "compose")
+
+    def __init__(self, target, log=None, window=240):
+        self.target = target
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.frames = deque(maxlen=window)  # (end, frame time)
+        self.history = {phase: deque(maxlen=window) for phase in self.PHASES}
+        self.blits = self.renders = 0
+        self.start = None
+        for phase, name in self.PHASES.items():
+            setattr(target, name, self.wrap(phase, getattr(target, name)))
+        self.log = None
+        if log:
+            self.log = open(log, "w")
+            self.log.write(
+                ",".join(["time", "frame_ms"] + list(self.PHASES) + ["blits", "renders"])
+                + "\n"
+            )
+
+    def wrap(self, phase, method):
+        times, calls = self.times, self.calls
 
-        self.appdirs = [
-            "/usr/share/applications/",
-            "~/.local/share/applications/",
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                times[phase] += time.perf_counter() - start
+                calls[phase] += 1
+
+        return timed
+
+    def close(self):
+        for name in self.PHASES.values():
+            self.target.__dict__.pop(name, None)
+        if self.log:
+            self.log.close()
+
+    def begin(self):
+        for phase in self.PHASES:
+            self.times[phase] = 0.0
+            self.calls[phase] = 0
+        self.misses = self.target.text.misses
+        self.start = time.perf_counter()
+
+    def end(self):
+        if self.start is None:
+            return
+        now = time.perf_counter()
+        frame = now - self.start
+        self.start = None
+        self.frames.append((now, frame))
+        for phase, t in self.times.items():
+            self.history[phase].append(t)
+        self.blits = sum(self.calls[phase] for phase in self.BLITS)
+        # a text cache miss renders the text and its shadow
+        self.renders = (self.target.text.misses - self.misses) * 2
+        if self.log:
+            ms = ",".join("{:.3f}".format(t * 1000) for t in [frame] + list(self.times.values()))
+            self.log.write("{:.6f},{},{},{}\n".format(now, ms, self.blits, self.renders))
+
+    def fps(self):
+        if not self.frames:
+            return 0
+        now = time.perf_counter()
+        return sum(1 for end, t in self.frames if now - end < 1)
+
+    def percentile(self, p):
+        if not self.frames:
+            return 0
+        times = sorted(t for end, t in self.frames)
+        return times[min(len(times) - 1, len(times) * p // 100)] * 1000
+
+    def mean(self, phase):
+        history = self.history[phase]
+        return sum(history) / len(history) * 1000 if history else 0
+
+    def lines(self):
+        return [
+            "{} fps, frame p50 {:.2f} p95 {:.2f} p99 {:.2f} ms".format(
+                self.fps(), self.percentile(50), self.percentile(95), self.percentile(99)
+            ),
+            "events {:.2f} cec {:.2f} icons {:.2f} animate {:.2f} flip {:.2f} ms".format(
+                *(self.mean(p) for p in ("events", "cec", "icons", "animate", "flip"))
+            ),
+            "layers {:.2f} compose {:.2f} ms, of that".format(
+                self.mean("layers"), self.mean("compose")
+            ),
+            "background {:.2f} tiles {:.2f} text {:.2f} ms".format(
+                *(self.mean(p) for p in ("background", "tiles", "text"))
+            ),
+            "last frame: {} blits, {} font.render".format(self.blits, self.renders),
         ]
 
-        self.apps = {}
+    def summary(self):
+        return "Profile: " + " | ".join(self.lines())
+
+
+class Latency:
+    # input-to-present time per input source (cec, key, joy), stamped where
+    # the input arrives and recorded when the frame reflecting it is shown
+    BUCKETS = (2, 4, 8, 16, 32, 64, 128, 256, 512)  # ms, upper bounds
+
+    def __init__(self):
+        self.pending = []
+        self.counts = defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self.recent = defaultdict(lambda: deque(maxlen=256))
+
+    def input(self, source, stamp):
+        self.pending.append((source, stamp))
+
+    def presented(self):
+        if not self.pending:
+            return
+        now = time.perf_counter()
+        for source, stamp in self.pending:
+            ms = (now - stamp) * 1000
+            self.counts[source][bisect.bisect_left(self.BUCKETS, ms)] += 1
+            self.recent[source].append(ms)
+        self.pending = []
+
+    def stats(self):
+        return ", ".join(
+            "{} latency: {:.1f} ms avg, {:.1f} ms max".format(
+                source, sum(recent) / len(recent), max(recent)
+            )
+            for source, recent in sorted(self.recent.items())
+        )
+
+    def dump(self):
+        lines = []
+        labels = ["<{}".format(b) for b in self.BUCKETS] + [">{}".format(self.BUCKETS[-1])]
+        for source, counts in sorted(self.counts.items()):
+            total = sum(counts)
+            lines.append("{} input-to-present, {} inputs:".format(source, total))
+            for label, n in zip(labels, counts):
+                if n:
+                    lines.append(
+                        "  {:>5} ms {:6} {}".format(label, n, "#" * max(1, n * 40 // total))
+                    )
+        return "\n".join(lines) or "No input latency recorded"
+
+
+class Clock:
+    # frame pacing and wall time for the loop
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+        self.start = time.perf_counter()
+
+    def tick(self, fps=0):
+        return self.clock.tick(fps)
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class VirtualClock:
+    # stands in for Clock during a replay: time only moves when set, and
+    # tick() never sleeps
+    def __init__(self, start):
+        self.start = start
+        self.t = 0.0
+        self.last = 0.0
+
+    def tick(self, fps=0):
+        dt = int(round((self.t - self.last) * 1000))
+        self.last = self.t
+        return dt
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.t)
+
+    def elapsed(self):
+        return self.t
+
+
+class Tween:
+    # a value eased from a to b over duration seconds; driven by elapsed
+    # time, so a slow frame skips ahead instead of slowing the motion down.
+    # region() gives the screen rect the animation touches this frame
+    def __init__(self, a, b, start, duration, region):
+        self.a = a
+        self.b = b
+        self.start = start
+        self.duration = duration
+        self.region = region
+
+    def progress(self, now):
+        if self.duration <= 0:
+            return 1.0
+        return min(1.0, max(0.0, (now - self.start) / self.duration))
+
+    def at(self, now):
+        t = 1 - (1 - self.progress(now)) ** 3  # ease out
+        return self.a + (self.b - self.a) * t
+
+
+class Animator:
+    # named tweens, all advanced to the same time once a frame by step(),
+    # which returns the rects they touch so only those are redrawn
+    def __init__(self, clock):
+        self.clock = clock
+        self.tweens = {}
+        self.now = 0.0
+        self.regions = {}  # name -> rect touched in the last step
+
+    def start(self, name, a, b, duration, region):
+        self.now = self.clock.elapsed()
+        self.tweens[name] = Tween(a, b, self.now, duration, region)
+
+    def stop(self, name):
+        self.tweens.pop(name, None)
+
+    def value(self, name, default=None):
+        tween = self.tweens.get(name)
+        return tween.at(self.now) if tween else default
+
+    def step(self):
+        self.now = self.clock.elapsed()
+        self.regions = {}
+        for name, tween in list(self.tweens.items()):
+            # a finished tween is dropped first, its last frame shows the
+            # resting value
+            if tween.progress(self.now) >= 1:
+                del self.tweens[name]
+            self.regions[name] = tween.region()
+        return list(self.regions.values())
+
+    def stats(self):
+        return "Animations: " + ", ".join(
+            "{} {}x{} at {},{}".format(name, r.w, r.h, r.x, r.y)
+            for name, r in self.regions.items()
+        )
+
+
+class Recorder:
+    # every input update() consumes, one JSON line per frame that had any:
+    # [t, inputs], t in seconds since start, inputs in the order handled
+    VERSION = 1
+
+    def __init__(self, fn, clock, config):
+        self.f = open(fn, "w")
+        self.f.write(
+            json.dumps(
+                {"version": self.VERSION, "start": clock.now().isoformat(), "config": config}
+            )
+            + "\n"
+        )
+        self.frame = None
+
+    def begin(self, t, events):
+        self.flush()
+        self.frame = [round(t, 4), []]
+        for ev in events:
+            rec = self.event(ev)
+            if rec:
+                self.frame[1].append(rec)
+
+    @staticmethod
+    def event(ev):
+        if ev.type == pygame.KEYDOWN:
+            return ["key", ev.key, ev.unicode]
+        if ev.type == pygame.JOYAXISMOTION:
+            return ["axis", ev.axis, round(ev.value, 3)]
+        if ev.type == pygame.JOYBUTTONDOWN:
+            return ["button", ev.button]
+        if ev.type == LAUNCH_EVENT:
+            return ["launch", ev.code]
+        if ev.type == pygame.QUIT:
+            return ["quit"]
+        return None
+
+    def cec(self, ev):
+        if self.frame:
+            self.frame[1].append(["cec", ev.key, ev.kind])
+
+    def flush(self):
+        if self.frame and self.frame[1]:
+            self.f.write(json.dumps(self.frame, separators=(",", ":")) + "\n")
+        self.frame = None
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class ReplayedLaunch:
+    # a launch during a replay: nothing is started, the recorded exit code
+    # comes back as a LAUNCH_EVENT
+    def __init__(self, cmd, clock):
+        self.cmd = cmd
+        self.clock = clock
+        self.start = clock.elapsed()
+        self.proc = None
+
+    def elapsed(self):
+        return self.clock.elapsed() - self.start
+
+
+def replay(log, config):
+    # feed a recorded session to a headless Homescreen on a virtual clock,
+    # as fast as it renders; returns frame timings and the final state
+    with open(log) as f:
+        header = json.loads(f.readline())
+        frames = [json.loads(line) for line in f if line.strip()]
+    clock = VirtualClock(datetime.datetime.fromisoformat(header["start"]))
+    h = Homescreen(cec_log=os.devnull, config=config, clock=clock)
+    # no tray, CEC or joystick threads, and launches only pretend
+    h.deferred.clear()
+    h.launcher = lambda cmd: ReplayedLaunch(cmd, clock)
+    h.launch_display = "keep"
+    h.done = False
+    h.last_date = None
+    h.date = None
+    h.update(0, [])
+    h.render()
+    while h.loading:
+        # icons don't change the state, but do change what frames cost
+        for future in list(h.loading):
+            future.exception()
+        h.update(0, [])
+        h.render()
+
+    types = {
+        "key": lambda key, unicode: pygame.event.Event(pygame.KEYDOWN, key=key, unicode=unicode),
+        "axis": lambda axis, value: pygame.event.Event(
+            pygame.JOYAXISMOTION, joy=0, instance_id=0, axis=axis, value=value
+        ),
+        "button": lambda button: pygame.event.Event(
+            pygame.JOYBUTTONDOWN, joy=0, instance_id=0, button=button
+        ),
+        "launch": lambda code: pygame.event.Event(LAUNCH_EVENT, code=code),
+        "quit": lambda: pygame.event.Event(pygame.QUIT),
+    }
+    times = []
+    start = time.perf_counter()
+    for t, inputs in frames:
+        clock.t = t
+        events = []
+        for kind, *args in inputs:
+            if kind == "cec":
+                h.cec.events.put(CecEvent(args[0], args[1], time.perf_counter()))
+            else:
+                events.append(types[kind](*args))
+        frame_start = time.perf_counter()
+        running = h.update(clock.tick(), events)
+        h.render()
+        times.append((time.perf_counter() - frame_start) * 1000)
+        if not running:
+            break
+    wall = time.perf_counter() - start
+    # leave the last frame of the real session in the cache
+    h.first_frame = False
+    h.close()
+
+    ordered = sorted(times) or [0]
+    return {
+        "frames": len(times),
+        "virtual_s": clock.t,
+        "wall_s": wall,
+        "speedup": clock.t / wall if wall else 0,
+        "frame_ms": [round(ms, 3) for ms in times],
+        "p50_ms": ordered[len(ordered) // 2],
+        "p95_ms": ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+        "max_ms": ordered[-1],
+        "state": {
+            "selection": h.selection,
+            "page": h.page,
+            "launched": h.launched,
+            "browsing": bool(h.browsing),
+            "query": h.query,
+            "done": h.done,
+        },
+    }
+
+
+class ScaledDisplay:
+    # the window and the surface frames are composed on: the window itself,
+    # or below render_scale 1 a smaller surface, upscaled into the window
+    # where it's damaged when presented
+    def __init__(self, res, scale=1.0, flags=0, smooth=False):
+        self.res = res
+        self.scale = scale
+        self.render_res = ivec2(vec2(res) * scale)
+        self.flags = flags
+        self.smooth = smooth
+        self.display = self.screen = None
+
+    def set_mode(self):
+        self.display = pygame.display.set_mode(self.res, self.flags)
+        if self.scale < 1:
+            self.screen = pygame.Surface(self.render_res).convert()
+        else:
+            self.screen = self.display
+        # render target to display pixels per axis as p:q; rects upscaled on
+        # their own only sample like the whole frame if their edges sit on
+        # multiples of p, so they're snapped to those. None: too fine a grid,
+        # upscale whole frames
+        self.scale_grid = None
+        if self.screen is not self.display:
+            grid = [
+                Fraction(s, d) for s, d in zip(self.screen.get_size(), self.display.get_size())
+            ]
+            if all(f.denominator <= 16 for f in grid):
+                self.scale_grid = [(f.numerator, f.denominator) for f in grid]
+
+    def upscale(self, rects):
+        # copy damaged rects of the render target to the display, scaled up.
+        # Nearest neighbour by default; render_smooth filters, at several
+        # times the cost, growing each rect by a pixel so the filter sees its
+        # real neighbours. Most of the screen damaged: one scale of the frame
+        if self.screen is self.display:
+            return rects
+        screen_rect = self.screen.get_rect()
+        display_rect = self.display.get_rect()
+        if not self.scale_grid or sum(r.w * r.h for r in rects) * 2 > screen_rect.w * screen_rect.h:
+            rects = [screen_rect]
+        scale = pygame.transform.smoothscale if self.smooth else pygame.transform.scale
+        pad = 2 if self.smooth else 0
+        out = []
+        for rect in rects:
+            src = rect.inflate(pad, pad).clip(screen_rect)
+            if not src:
+                continue
+            if src == screen_rect:
+                dst = display_rect
+            else:
+                edges = []
+                for lo, hi, size, out_size, (p, q) in (
+                    (src.left, src.right, screen_rect.w, display_rect.w, self.scale_grid[0]),
+                    (src.top, src.bottom, screen_rect.h, display_rect.h, self.scale_grid[1]),
+                ):
+                    lo, hi = lo // p, -(-hi // p)
+                    edges.append(
+                        (lo * p, min(hi * p, size), lo * q, min(hi * q, out_size))
+                    )
+                (x0, x1, dx0, dx1), (y0, y1, dy0, dy1) = edges
+                src = pygame.Rect(x0, y0, x1 - x0, y1 - y0)
+                dst = pygame.Rect(dx0, dy0, dx1 - dx0, dy1 - dy0)
+            scale(self.screen.subsurface(src), dst.size, self.display.subsurface(dst))
+            out.append(dst)
+        return out
+
+
+def merge_rects(rects):
+    # union overlapping rects so no area is composed twice
+    merged = []
+    for rect in rects:
+        i = rect.collidelist(merged)
+        while i != -1:
+            rect = rect.union(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+# Raster buffers passed around (and cached) are premultiplied BGRA, which is
+# what cairo's ARGB32 looks like in memory on little-endian machines. They are
+# wrapped as pygame surfaces without copying, convert_alpha() is the only copy,
+# and get blitted with PREMULTIPLIED.
+PREMULTIPLIED = pygame.BLEND_PREMULTIPLIED
+
+
+def cairo_buffer(surface):
+    surface.flush()
+    data = surface.get_data()
+    if sys.byteorder == "little":
+        return data
+    # ARGB in memory, reorder the channels
+    from PIL import Image
+
+    w, h = surface.get_width(), surface.get_height()
+    im = Image.frombuffer("RGBA", (w, h), data, "raw", "ARGB", surface.get_stride(), 1)
+    return im.tobytes("raw", "BGRA")
+
+
+def buffer_to_surface(buf, sz):
+    return pygame.image.frombuffer(buf, tuple(sz), "BGRA").convert_alpha()
+
+
+def cairo_to_surface(surface):
+    return buffer_to_surface(
+        cairo_buffer(surface), (surface.get_width(), surface.get_height())
+    )
+
 
+rsvg = None
+
+
+def load_rsvg():
+    # gi and Rsvg are slow to import, they wait for the first SVG to render
+    global rsvg
+    if rsvg is None:
+        import gi
+
+        gi.require_version("Rsvg", "2.0")
+        from gi.repository import Rsvg
+
+        rsvg = Rsvg
+    return rsvg
+
+
+def render_svg(fn, sz):
+    import cairo
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *sz)
+    ctx = cairo.Context(surface)
+    svg = load_rsvg().Handle.new_from_file(fn)
+    dim = svg.get_dimensions()
+    dim = ivec2(dim.width, dim.height)
+    scale = sz[0] / dim[0]
+    ctx.scale(scale, scale)
+    svg.render_cairo(ctx)
+    return cairo_buffer(surface)
+
+
+def render_background(fn, sz, radius):
+    from PIL import Image, ImageFilter
+
+    im = Image.open(fn)
+    # lets JPEG decode straight to a smaller size
+    im.draft("RGB", tuple(sz))
+    im = im.convert("RGB")
+    # scale to cover the screen, then crop the overflow
+    scale = max(sz[0] / im.width, sz[1] / im.height)
+    w = max(sz[0], round(im.width * scale))
+    h = max(sz[1], round(im.height * scale))
+    im = im.resize((w, h), Image.BILINEAR, reducing_gap=2.0)
+    x, y = (w - sz[0]) // 2, (h - sz[1]) // 2
+    im = im.crop((x, y, x + sz[0], y + sz[1]))
+    # blur after scaling, the cost no longer depends on the source size
+    if radius:
+        im = im.filter(ImageFilter.GaussianBlur(radius=radius))
+    return im.tobytes()
+
+
+def render_png(fn, sz):
+    from PIL import Image
+
+    im = Image.open(fn).convert("RGBA")
+    im = im.resize(tuple(sz), Image.LANCZOS)
+    # packing as BGRa premultiplies on the way out
+    return im.tobytes("raw", "BGRa")
+
+
+class Entry:
+    # one app; slotted and without the parsed desktop file, as the catalog
+    # and the browser can hold hundreds of these
+    __slots__ = ("name", "icon_fn", "run", "icon", "pending", "failed")
+
+    def __init__(self, name, icon_fn, run):
+        self.name = name
+        self.icon_fn = icon_fn
+        self.run = run
+        self.icon = None
+        self.pending = False
+        self.failed = False
+
+    def __repr__(self):
+        return "Entry({!r}, {!r}, {!r})".format(self.name, self.icon_fn, self.run)
+
+
+class IconPool:
+    # uploaded icon surfaces within a byte budget, least recently drawn go
+    # first; icons on screen (visible() gives their entry ids) are kept
+    def __init__(self, max_bytes, visible):
+        self.max_bytes = max_bytes
+        self.visible = visible
+        self.entries = OrderedDict()  # id(entry) -> entry
+        self.bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def size(icon):
+        return icon.get_width() * icon.get_height() * icon.get_bytesize()
+
+    def add(self, entry, icon):
+        self.drop(entry)
+        entry.icon = icon
+        self.entries[id(entry)] = entry
+        self.bytes += self.size(icon)
+        if self.bytes > self.max_bytes:
+            self.evict()
+
+    def touch(self, entry):
+        try:
+            self.entries.move_to_end(id(entry))
+        except KeyError:
+            pass
+
+    def drop(self, entry):
+        if self.entries.pop(id(entry), None) is not None:
+            self.bytes -= self.size(entry.icon)
+        entry.icon = None
+
+    def loaded(self):
+        return list(self.entries.values())
+
+    def evict(self):
+        visible = self.visible()
+        for key, entry in list(self.entries.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if key not in visible:
+                self.drop(entry)
+                self.evictions += 1
+
+    def stats(self):
+        return "icons: {} resident, {} KB of {} KB, {} evictions".format(
+            len(self.entries), self.bytes // 1024, self.max_bytes // 1024, self.evictions
+        )
+
+
+def sizeof(obj, seen=None):
+    # rough deep size of plain containers, for the memory report
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(sizeof(v, seen) for v in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(sizeof(getattr(obj, k, None), seen) for k in obj.__slots__)
+    return size
+
+
+class Catalog:
+    # index of desktop files (stem -> name, exec, icon), so only files that
+    # are actually needed get parsed, and only again when their mtime changes
+    VERSION = 2
+
+    def __init__(self, appdirs, path=None):
+        self.appdirs = [os.path.expanduser(d) for d in appdirs]
+        self.path = path or os.path.join(CACHE_DIR, "catalog.json")
+        self.dirs = {}  # dir -> [mtime, {stem: filename}]
+        # path -> [mtime, name, exec, icon, generic name, keywords, hidden],
+        # [mtime] if invalid
+        self.files = {}
+        self.checked = set()
+        self.changed = False
+        self.parsed = 0
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.dirs = data["dirs"]
+                self.files = data["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"version": self.VERSION, "dirs": self.dirs, "files": self.files}, f
+                )
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Catalog:", e)
+            return
+        self.changed = False
+
+    def listing(self, appdir):
+        # stem -> filename, relisted only when the directory mtime changes
+        if appdir in self.checked:
+            return self.dirs.get(appdir, [0, {}])[1]
+        self.checked.add(appdir)
+        try:
+            mtime = os.stat(appdir).st_mtime_ns
+        except OSError:
+            if self.dirs.pop(appdir, None):
+                self.changed = True
+            return {}
+        cached = self.dirs.get(appdir)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = os.listdir(appdir)
+        except OSError:
+            names = []
+        stems = {
+            os.path.splitext(fn)[0].lower(): fn
+            for fn in names
+            if fn.endswith(".desktop")
+        }
+        self.dirs[appdir] = [mtime, stems]
+        self.changed = True
+        return stems
+
+    def record(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        rec = self.files.get(path)
+        if rec and rec[0] == mtime:
+            return rec if len(rec) > 1 else None
+        import xdg.DesktopEntry
+        import xdg.Exceptions
+
+        de = xdg.DesktopEntry.DesktopEntry()
+        self.parsed += 1
+        self.changed = True
+        try:
+            de.parse(path)
+        except xdg.Exceptions.ParsingError:
+            self.files[path] = [mtime]
+            return None
+        self.files[path] = rec = [
+            mtime,
+            de.getName(),
+            de.getExec(),
+            de.getIcon(),
+            de.getGenericName(),
+            de.getKeywords(),
+            de.getNoDisplay() or de.getHidden(),
+        ]
+        return rec
+
+    def entry(self, rec):
+        return Entry(rec[1], rec[3], os.path.expanduser(rec[2]))
+
+    def get(self, stem):
+        # later directories (~/.local) override earlier ones
+        for appdir in reversed(self.appdirs):
+            fn = self.listing(appdir).get(stem)
+            if fn:
+                rec = self.record(os.path.join(appdir, fn))
+                if rec:
+                    return self.entry(rec)
+        return None
+
+    def records(self):
+        recs = {}
+        paths = set()
         for appdir in self.appdirs:
-            appdir = os.path.expanduser(appdir)
-            for path in os.listdir(appdir):
-                de = xdg.DesktopEntry.DesktopEntry()
+            for stem, fn in self.listing(appdir).items():
+                path = os.path.join(appdir, fn)
+                paths.add(path)
+                rec = self.record(path)
+                if rec:
+                    recs[stem] = rec
+        # forget files that are gone
+        for path in set(self.files) - paths:
+            del self.files[path]
+            self.changed = True
+        return recs
+
+    def all(self):
+        return {stem: self.entry(rec) for stem, rec in self.records().items()}
+
+
+class SearchIndex:
+    # substring search over a list of documents (lists of terms), short words
+    # through a sorted term list, longer ones through trigrams; a query that
+    # extends the previous one only narrows the previous results
+    def __init__(self, docs):
+        self.docs = [[t.lower() for t in doc] for doc in docs]
+        self.text = [" ".join(doc) for doc in self.docs]
+        self.terms = sorted((t, i) for i, doc in enumerate(self.docs) for t in set(doc))
+        self.trigrams = defaultdict(set)
+        for i, text in enumerate(self.text):
+            for j in range(len(text) - 2):
+                self.trigrams[text[j : j + 3]].add(i)
+        self.last = ("", None)
+
+    def prefixed(self, word):
+        ids = set()
+        for j in range(bisect.bisect_left(self.terms, (word,)), len(self.terms)):
+            term, i = self.terms[j]
+            if not term.startswith(word):
+                break
+            ids.add(i)
+        return ids
+
+    def candidates(self, word):
+        if len(word) < 3:
+            return self.prefixed(word)
+        grams = [self.trigrams.get(word[j : j + 3], set()) for j in range(len(word) - 2)]
+        return set.intersection(*sorted(grams, key=len))
+
+    def match(self, i, word):
+        if len(word) < 3:
+            return any(t.startswith(word) for t in self.docs[i])
+        return word in self.text[i]
+
+    def narrows(self, prev, query):
+        # short words match term prefixes, long ones any substring, so results
+        # only carry over while a word stays on the same side of that line
+        if not prev or not query.startswith(prev):
+            return False
+        old, new = prev.split(), query.split()
+        if not old or prev[-1].isspace():
+            return True
+        word = new[len(old) - 1]
+        return len(old[-1]) >= 3 or len(word) < 3
+
+    def search(self, query):
+        # ids of matching documents in document order, None for everything
+        query = query.lower()
+        words = query.split()
+        if not words:
+            self.last = (query, None)
+            return None
+        prev, ids = self.last
+        if ids is None or not self.narrows(prev, query):
+            ids = sorted(min((self.candidates(w) for w in words), key=len))
+        ids = [i for i in ids if all(self.match(i, w) for w in words)]
+        self.last = (query, ids)
+        return ids
+
+
+class IconIndex:
+    # icon name -> candidate files for a theme and everything it inherits,
+    # rebuilt only when one of the theme directories changes
+    VERSION = 1
+
+    def __init__(self, theme=None, path=None, prefer=("svg", "png")):
+        if not theme:
+            import xdg.Config
+
+            theme = xdg.Config.icon_theme
+        self.theme = theme
+        self.path = path or os.path.join(CACHE_DIR, "icons-{}.json".format(self.theme))
+        self.prefer = prefer
+        self.dirs = {}  # dir -> mtime
+        self.icons = {}  # name -> [[rank, type, size, min, max, threshold, path]]
+        self.resolved = {}
+        self.lock = threading.Lock()
+        self.ready = False
+        self.rebuilt = False
+
+    def ensure(self):
+        with self.lock:
+            if self.ready:
+                return
+            if not self.read():
+                self.build()
+                self.write()
+                self.rebuilt = True
+            self.ready = True
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != self.VERSION:
+            return False
+        for path, mtime in data["dirs"].items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+        self.dirs = data["dirs"]
+        self.icons = data["icons"]
+        return True
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"version": self.VERSION, "dirs": self.dirs, "icons": self.icons}, f
+                )
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Icon index:", e)
+
+    def mtime(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        self.dirs[path] = mtime
+        return mtime
+
+    def find(self, name):
+        import xdg.IconTheme
+        import xdg.Exceptions
+
+        for base in xdg.IconTheme.icondirs:
+            fn = os.path.join(base, name, "index.theme")
+            if self.mtime(fn) is not None:
+                theme = xdg.IconTheme.IconTheme()
                 try:
-                    de.parse(os.path.join(appdir, path))
+                    theme.parse(fn)
                 except xdg.Exceptions.ParsingError:
                     continue
-                name = de.getName()
-                run = os.path.expanduser(de.getExec())
-                icon_fn = de.getIcon()
-                fn = os.path.splitext(path)[0].lower()
-                # print(fn)
+                return theme
+        return None
+
+    def chain(self):
+        # the theme, everything it inherits, then hicolor
+        themes = []
+        pending = [self.theme]
+        while pending or "hicolor" not in themes:
+            name = pending.pop(0) if pending else "hicolor"
+            if name in themes:
+                continue
+            themes.append(name)
+            theme = self.find(name)
+            if theme:
+                yield name, theme
+                pending.extend(theme.getInherits())
+
+    def build(self):
+        import xdg.IconTheme
+
+        self.dirs = {}
+        self.icons = {}
+        self.resolved = {}
+        rank = 0
+        for name, theme in self.chain():
+            for subdir in theme.getDirectories():
+                info = [
+                    rank,
+                    theme.getType(subdir),
+                    theme.getSize(subdir) or 0,
+                    theme.getMinSize(subdir) or 0,
+                    theme.getMaxSize(subdir) or 0,
+                    theme.getThreshold(subdir) or 0,
+                ]
+                for base in xdg.IconTheme.icondirs:
+                    self.scan(os.path.join(base, name, subdir), info)
+            rank += 1
+        # unthemed icons (/usr/share/pixmaps) come last
+        for base in xdg.IconTheme.icondirs:
+            self.scan(base, [rank, "Fixed", 0, 0, 0, 0])
+
+    def scan(self, path, info):
+        if self.mtime(path) is None:
+            return
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        for fn in names:
+            name, ext = os.path.splitext(fn)
+            if ext[1:] in self.prefer:
+                self.icons.setdefault(name, []).append(info + [os.path.join(path, fn)])
+
+    def distance(self, cand, size):
+        rank, kind, sz, lo, hi, threshold, path = cand
+        if kind == "Threshold":
+            lo, hi = sz - threshold, sz + threshold
+        elif kind != "Scalable":
+            lo = hi = sz
+        if size < lo:
+            return lo - size
+        if size > hi:
+            return size - hi
+        return 0
+
+    def lookup(self, name, size):
+        if os.path.isabs(name):
+            return name
+        key = (name, size)
+        try:
+            return self.resolved[key]
+        except KeyError:
+            pass
+        self.ensure()
+        stem, ext = os.path.splitext(name)
+        if ext[1:] in self.prefer:
+            name = stem
+        best = None
+        for cand in self.icons.get(name, ()):
+            score = (
+                cand[0],
+                self.distance(cand, size),
+                self.prefer.index(os.path.splitext(cand[-1])[1][1:]),
+            )
+            if best is None or score < best[0]:
+                best = score, cand[-1]
+        path = self.resolved[key] = best[1] if best else None
+        return path
+
+
+class Homescreen:
+    def __init__(
+        self,
+        rebuild_cache=False,
+        debug=False,
+        cec_log=None,
+        config="config.yaml",
+        profile=False,
+        profile_log=None,
+        record=None,
+        clock=None,
+    ):
+        self.start_time = self.stage_time = time.perf_counter()
+        self.first_frame = False
+        # startup in stages, timed: the window and last frame come first,
+        # CEC and joysticks are started from the loop once something is shown
+        self.stages = []
+        self.deferred = deque([("cec", self.start_cec), ("joystick", self.init_joysticks)])
+
+        self.config = config
+        self.config_mtime = os.stat(config).st_mtime_ns
+        with open(config, "r") as cfg:
+            self.cfg = yaml.safe_load(cfg)
+
+
+        self.debug = debug or self.cfg.get("debug", False)
+        self.fullscreen = self.cfg.get("fullscreen", False)
+        self.theme = self.cfg.get("theme", None)
+        self.browser = self.cfg.get("browser", None)
+        # everything is composed at res, render_scale times the display
+        # resolution, and upscaled once when presented
+        self.display_res = ivec2(*self.cfg.get("resolution", (1920, 1080)))
+        self.scale = max(0.1, min(1.0, float(self.cfg.get("render_scale", 1.0))))
+        self.res = ivec2(vec2(self.display_res) * self.scale)
+        
+        self.icon_sz = self.config_icon_size(self.cfg)
+
 
-                self.apps[fn] = entry = Entry(name, icon_fn, run, de)
+        self.stage("config")
 
         found = False
-        pygame.init()
+        # only what the first frame needs, no audio or joysticks yet
+        pygame.display.init()
+        pygame.font.init()
         pygame.mouse.set_visible(False)
         pygame.display.set_caption("Couch Mode")
         # drivers = ['fbcon', 'directfb', 'svgalib']
@@ -133,72 +1594,161 @@ class Homescreen:
         #     return None
         self.flags = pygame.DOUBLEBUF | \
             pygame.FULLSCREEN if self.fullscreen else 0
-        self.screen = pygame.display.set_mode(
-            self.res, self.flags
+        self.output = ScaledDisplay(
+            self.display_res, self.scale, self.flags, self.cfg.get("render_smooth", False)
         )
+        self.set_mode()
         pygame.key.set_repeat(100, 100)
+        self.stage("display")
+
+        # what was on screen last time, until the real first frame is ready
+        self.frame_cache = RasterCache(os.path.join(CACHE_DIR, "frames"), 16 * 1024 * 1024, 3)
+        self.frame_key = self.frame_cache.key(config, self.res, "frame")
+        self.show_last_frame()
+        self.stage("last frame")
+
+        self.icon_cache = RasterCache(
+            max_bytes=self.cfg.get("icon_cache_size", 32) * 1024 * 1024
+        )
+        self.background_cache = RasterCache(
+            os.path.join(CACHE_DIR, "backgrounds"),
+            self.cfg.get("background_cache_size", 64) * 1024 * 1024,
+            channels=3,
+        )
+        if rebuild_cache:
+            self.icon_cache.clear()
+            self.background_cache.clear()
+
+        # icons are rasterized off the render thread, only the final
+        # convert_alpha() happens in update()
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.cfg.get("icon_workers", os.cpu_count() or 2)
+        )
+        self.loading = {}
+        self.icons_loaded = False
+        self.icon_index = IconIndex(self.theme)
+        self.icons = IconPool(
+            self.cfg.get("icon_memory", 16) * 1024 * 1024, self.visible_entries
+        )
+
+        self.appdirs = self.cfg.get(
+            "appdirs",
+            [
+                "/usr/share/applications/",
+                "~/.local/share/applications/",
+            ],
+        )
+
+        self.apps = {}
+        self.catalog = Catalog(self.appdirs)
+
+        # started from the loop, after pygame so its key events can be posted
+        self.cec = CEC(self.cfg.get("cec_client", "cec-client"), cec_log)
+        self.stage("caches")
+
+        # launched apps, and what happens to our window while they run:
+        # keep, hide (iconify) or quit
+        self.commands = {
+            "@desktop": self.exit,
+            "@apps": self.browse,
+        }
+        self.child = None
+        self.launcher = Launcher
+        self.launched = None
+        self.launch_display = self.cfg.get("launch_display", "hide")
+        self.display_state = None
+        self.return_time = None
+
+        self.fps = self.cfg.get("fps", 60)
+        self.idle_timeout = 60 * 1000
+        # set while something is animating, the loop only polls at self.fps then
+        self.animating = False
         self.page = 0
-        self.pages = [pygame.Surface(self.res).convert_alpha()]
-        for page in self.pages:
-            page.fill((0,0,0,0))
+        # static layer for the visible page and its neighbours: background,
+        # panel, icons and labels, recomposed only where page_damage says so
+        self.pages = {}
+        self.page_damage = defaultdict(list)
         # buf.fill((0,0,0))
 
-        self.clock = pygame.time.Clock()
-
-        try:
-            fn = self.cfg["background"]
-            self.background = Image.open(os.path.expanduser(fn))
-            # self.background = pygame.image.load(os.path.expanduser(fn))
-        except pygame.error:
-            self.background = None
-        if self.background:
-            # self.background = self.background.resize((1920 + 64, 1080 + 64), Image.ANTIALIAS)
-            self.background = self.background.filter(ImageFilter.GaussianBlur(radius=8))
-            self.background = pygame.image.fromstring(
-                self.background.tobytes(), self.background.size, self.background.mode
+        # replays pass a VirtualClock
+        self.clock = clock or Clock()
+
+        # selector movement, focused icon scale and page slides, stepped from
+        # render() by elapsed time; with none active there's nothing to do
+        self.anim = Animator(self.clock)
+        self.anim_time = self.cfg.get("animation_time", 0.15)
+        self.selector_drawn = None  # where the selector was last drawn
+        self.focus_icon = None  # (icon, icon scaled to FOCUS)
+        self.slide_from = self.slide_dir = None
+
+        # one wallpaper or a list to rotate through, downscaled and blurred
+        # once, then served from the background cache
+        backgrounds = self.cfg.get("background") or []
+        if isinstance(backgrounds, str):
+            backgrounds = [backgrounds]
+        self.backgrounds = [os.path.expanduser(fn) for fn in backgrounds]
+        self.blur = self.cfg.get("background_blur", 8)
+        self.background_index = 0
+        self.background_future = None
+        self.fade_from = None
+        self.fade_layer = None  # the layer fading in, its alpha set by fade()
+        self.fade_start = 0
+        self.fade_time = self.cfg.get("background_fade", 1.0)
+        self.background = None
+        if self.backgrounds:
+            try:
+                self.background = self.upload_background(
+                    self.prepare_background(self.backgrounds[0])
+                )
+            except (OSError, ValueError) as e:
+                print("Background:", e)
+        if len(self.backgrounds) > 1:
+            pygame.time.set_timer(
+                BACKGROUND_EVENT, int(self.cfg.get("background_interval", 300) * 1000)
             )
-            self.background = self.background.convert()
 
-        # my_apps = list(apps.keys()) # all
-        self.my_apps = self.cfg["apps"]
+        self.stage("background")
 
-        self.tray = [
-            "/usr/share/icons/Faenza/status/scalable/audio-volume-high.svg",
-            "/usr/share/icons/Faenza/status/scalable/nm-signal-100.svg",
-        ]
+        # status icons, polled in the background from the first frame on;
+        # the icons for every state are rasterized up front
+        self.tray = []
+        for name in self.cfg.get("tray", ["volume", "network", "cec", "battery"]):
+            if name == "cec":
+                self.tray.append(CecPowerProvider(self.cec))
+            else:
+                self.tray.append(TRAY_PROVIDERS[name]())
         self.tray_sz = ivec2(self.res[0] // 60)
-        for i, fn in enumerate(self.tray):
-            self.tray[i] = self.load_svg(fn, self.tray_sz)
-
-        for i, app in enumerate(self.my_apps[:]):
-            if type(app) is dict:
-                key = list(app)[0]
-                # print(key)
-                # name = app[0]
-                # info = app[1]
-                # print('key',key)
-                # print('app',app)
-                app = app[key]
-                # print(key)
-                name = app.get("name", key)
-                run = app.get("run", None)
-                if run:
-                    run = os.path.expanduser(run)
-                else:
-                    run = key
-                web = app.get("web", None)
-                if web:
-                    run = self.browser + " " + web
-                icon = app.get("icon", key)
-                icon = os.path.expanduser(icon)
-                self.apps[key] = entry = Entry(name, icon, run)
-                # print('key', key)
-                # print('entry', entry)
-                self.my_apps[i] = key
+        self.tray_icons = {}
+        self.tray_loading = {}
+        self.tray_shown = []
+        for provider in self.tray:
+            for state, icon in provider.icons.items():
+                future = self.pool.submit(self.load_status_icon, icon, self.tray_sz)
+                future.add_done_callback(lambda f: wake(TRAY_EVENT))
+                self.tray_loading[future] = (provider, state)
+        w = len(self.tray) * (self.tray_sz[0] + 12) + 24
+        self.tray_rect = pygame.Rect(self.res[0] - w, 0, w, self.tray_sz[1] + 2)
+        self.deferred.append(("tray", self.start_tray))
+
+        self.my_apps, self.config_entries = self.config_apps(self.cfg["apps"])
+        self.apps.update(self.config_entries)
+
+        self.stage("apps")
 
         self.selection = 0
 
-        self.dirty = True
+        self.damage = []
+        self.pixels = 0
+        self.stats_time = time.perf_counter()
+        self.stats_cpu = time.process_time()
+        self.date_pos = ivec2(self.res[0] / 2, 8)
+        self.date_rect = pygame.Rect(0, 0, 0, 0)
+        # @apps browser: home grid while browsing, search index, type-ahead
+        self.browsing = None
+        self.search = None
+        self.query = ""
+        self.query_pos = ivec2(self.res[0] / 4, 8)
+        self.query_rect = pygame.Rect(0, 0, 0, 0)
         self.border = ivec2(
             self.res[0] // 4,
             self.res[0] // 32
@@ -208,22 +1758,19 @@ class Homescreen:
         # self.padding = ivec2(0,0)
         # self.y_wrap = self.res[0] - self.icon_sz[0] - self.padding[0] * 2 - self.border * 2
         self.grid = [4,3]
+        self.per_page = self.grid[0] * self.grid[1]
         # self.y_wrap = self.res[0] - self.icon_sz[0] - self.padding[0] // 2
         # grid = y_wrap // (self.res[0] - self.icon_sz[0])
         
         # print(grid)
 
-        pygame.font.init()
-        pygame.joystick.init()
-
-        self.joysticks = [
-            pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())
-        ]
+        self.joysticks = []
         self.joy_axis = defaultdict(lambda: [0, 0])
-        for joy in self.joysticks:
-            joy.init()
 
-        self.font = pygame.font.Font(pygame.font.get_default_font(), self.res[0] // 80)
+        self.text = TextCache(self.cfg.get("text_cache_size", 4) * 1024 * 1024)
+        # sized for res, so text is rasterized at the pixel size it's composed at
+        self.font_size = max(10, self.res[0] // 80)
+        self.font = self.text.font(self.font_size)
 
         w, h = self.icon_sz
         self.selector_sz = ivec2(
@@ -232,30 +1779,123 @@ class Homescreen:
         )
         # self.selector_sz = ivec2(self.selector_sz * (self.res[0]/1920))
         self.selector = self.draw_selector(self.selector_sz)
-        self.panel_sz = ivec2(self.res[0], 76)
+        self.panel_sz = ivec2(self.res[0], int(76 * self.scale))
         self.panel = self.draw_panel(self.panel_sz)
+        self.invalidate_pages()
         # self.selector.set_alpha(128)
         # self.selector = pygame.Surface(icon_sz).convert_alpha()
         # self.selector.fill((0,0,0))
+        self.placeholder = self.draw_selector(self.icon_sz, DARK_GRAY[:3])
+        self.stage("layout")
+
+        # input latency, dumped with F4 or SIGUSR1 (memory: F5 or SIGUSR2)
+        self.latency = Latency()
+        self.input = None
+        self.dequeued = None
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: wake(DUMP_EVENT, what="latency"))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: wake(DUMP_EVENT, what="memory"))
+        except (AttributeError, ValueError):
+            pass
+
+        # frame profiler and its overlay, toggled with F3
+        self.profiler = None
+        self.profile_log = profile_log or self.cfg.get("profile_log")
+        self.hud = None
+        self.hud_rect = pygame.Rect(0, 0, 0, 0)
+        if profile or self.profile_log or self.cfg.get("profile", False):
+            self.toggle_profiler()
+
+        self.ensure_pages()
+        if self.catalog.parsed:
+            print("Catalog: parsed {} desktop files".format(self.catalog.parsed))
+        self.stage("icons queued")
+
+        # inputs reaching update(), for replay()
+        self.recorder = Recorder(record, self.clock, config) if record else None
+
+        # picked up again when it changes, checked every config_poll seconds
+        pygame.time.set_timer(CONFIG_EVENT, int(self.cfg.get("config_poll", 2) * 1000))
+
+    def config_icon_size(self, cfg):
+        # icon_size is in display pixels, icons are rasterized at res
+        if "icon_size" in cfg:
+            return ivec2(vec2(cfg["icon_size"]) * self.scale)
+        return ivec2(self.res[0] / 12.3)
+
+    def set_mode(self):
+        self.output.set_mode()
+        self.display, self.screen = self.output.display, self.output.screen
+
+    def stage(self, name):
+        now = time.perf_counter()
+        self.stages.append((name, now - self.stage_time))
+        self.stage_time = now
+
+    def start_cec(self):
+        self.cec.start()
 
-        for app in self.my_apps:
+    def start_tray(self):
+        for provider in self.tray:
+            provider.start()
+
+    def poll_tray(self):
+        for future in [f for f in self.tray_loading if f.done()]:
+            key = self.tray_loading.pop(future)
             try:
-                # print('app2', app)
-                self.load(self.apps[app])
-            except ValueError as e:
-                print(e)
-                pass
-            except KeyError as e:
-                print(e)
-                pass
-                # pygame.quit()
-                # raise
+                buf = future.result()
+            except Exception:
+                buf = None
+            if buf:
+                self.tray_icons[key] = self.upload(buf, self.tray_sz)
+        # only redraw when what's shown changes
+        shown = [
+            self.tray_icons.get((provider, provider.state)) for provider in self.tray
+        ]
+        shown = [icon for icon in shown if icon]
+        if shown != self.tray_shown:
+            self.tray_shown = shown
+            self.invalidate(self.tray_rect)
+
+    def init_joysticks(self):
+        pygame.joystick.init()
+        self.joysticks = [
+            pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())
+        ]
+        for joy in self.joysticks:
+            joy.init()
+
+    def run_deferred(self):
+        name, init = self.deferred.popleft()
+        start = time.perf_counter()
+        init()
+        self.stages.append((name, time.perf_counter() - start))
+        if not self.deferred:
+            print(
+                "Startup: "
+                + ", ".join("{} {:.0f} ms".format(n, t * 1000) for n, t in self.stages)
+            )
+
+    def show_last_frame(self):
+        buf = self.frame_cache.get(self.frame_key, self.res)
+        if buf:
+            self.screen.blit(pygame.image.frombuffer(buf, tuple(self.res), "RGB"), (0, 0))
+            self.upscale([self.screen.get_rect()])
+            pygame.display.flip()
+
+    def save_frame(self):
+        if self.first_frame and not self.display_state:
+            self.frame_cache.put(
+                self.frame_key, self.res, pygame.image.tostring(self.screen, "RGB")
+            )
 
     def draw_selector(self, sz, col=(255, 255, 255)):
+        import cairo
+
         w, h = sz
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
         ctx = cairo.Context(surface)
-        rad = 18.5
+        rad = 18.5 * self.scale
         deg = math.pi / 180
         x, y = 0, 0
         ctx.new_sub_path()
@@ -266,20 +1906,18 @@ class Homescreen:
         ctx.close_path()
         ctx.set_source_rgba(*(vec4(vec3(col) / 255, 0.5)))
         ctx.fill_preserve()
-        ctx.set_line_width(4.0)
+        ctx.set_line_width(4.0 * self.scale)
         ctx.set_source_rgba(*(vec4(vec3(col) / 255, 0.8)))
         ctx.stroke()
-        im = Image.frombuffer(
-            "RGBA", (w, h), surface.get_data().tobytes(), "raw", "BGRA", 0, 0
-        )
-        buf = im.tobytes()
-        return pygame.image.fromstring(buf, (w, h), "RGBA").convert_alpha()
+        return cairo_to_surface(surface)
 
     def draw_panel(self, sz, col=(0, 0, 0)):
+        import cairo
+
         w, h = sz
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
         ctx = cairo.Context(surface)
-        rad = 18.5
+        rad = 18.5 * self.scale
         deg = math.pi / 180
         x, y = 0, 0
         ctx.new_sub_path()
@@ -296,55 +1934,368 @@ class Homescreen:
         # scale = self.icon_sz[0]/dim[0]
         # ctx.scale(scale,scale)
         # svg.render_cairo(ctx)
-        im = Image.frombuffer(
-            "RGBA", (w, h), surface.get_data().tobytes(), "raw", "BGRA", 0, 0
-        )
-        buf = im.tobytes()
-        return pygame.image.fromstring(buf, (w, h), "RGBA").convert_alpha()
+        return cairo_to_surface(surface)
 
     def load_svg(self, fn, sz):
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *sz)
-        ctx = cairo.Context(surface)
-        svg = rsvg.Handle.new_from_file(fn)
-        dim = svg.get_dimensions()
-        dim = ivec2(dim.width, dim.height)
-        scale = sz[0] / dim[0]
-        ctx.scale(scale, scale)
-        svg.render_cairo(ctx)
-        im = Image.frombuffer(
-            "RGBA", tuple(sz), surface.get_data().tobytes(), "raw", "BGRA", 0, 0
+        return self.upload(self.rasterize(render_svg, fn, sz), sz)
+
+    def rasterize(self, render, fn, sz):
+        key = self.icon_cache.key(fn, sz, self.theme)
+        buf = self.icon_cache.get(key, sz)
+        if buf is None:
+            buf = render(fn, sz)
+            self.icon_cache.put(key, sz, buf)
+        return buf
+
+    def upload(self, buf, sz):
+        return buffer_to_surface(buf, sz)
+
+    # runs on the icon loader threads
+    def prepare_background(self, fn):
+        key = self.background_cache.key(fn, self.res, self.blur)
+        buf = self.background_cache.get(key, self.res)
+        if buf is None:
+            buf = render_background(fn, self.res, self.blur)
+            self.background_cache.put(key, self.res, buf)
+        return buf
+
+    def upload_background(self, buf):
+        return pygame.image.fromstring(buf, tuple(self.res), "RGB").convert()
+
+    def next_background(self):
+        if self.background_future:
+            return
+        self.background_index = (self.background_index + 1) % len(self.backgrounds)
+        fn = self.backgrounds[self.background_index]
+        self.background_future = self.pool.submit(self.prepare_background, fn)
+        self.background_future.add_done_callback(lambda f: wake(LOAD_EVENT))
+
+    def poll_background(self):
+        future = self.background_future
+        if not future or not future.done():
+            return
+        self.background_future = None
+        try:
+            buf = future.result()
+        except (OSError, ValueError) as e:
+            # PIL's UnidentifiedImageError is an OSError
+            print("Background:", e)
+            return
+        self.end_fade()
+        self.background = self.upload_background(buf)
+        # crossfade from the current layer to the rebuilt one
+        self.fade_from = self.pages[self.page]
+        self.fade_start = self.clock.elapsed()
+        self.animating = True
+        self.invalidate_pages()
+
+    def config_apps(self, apps):
+        # desktop file stems, or {key: {name, icon, run or web}} for custom ones
+        keys = []
+        entries = {}
+        for app in apps:
+            if type(app) is dict:
+                key = list(app)[0]
+                app = app[key]
+                name = app.get("name", key)
+                run = app.get("run", None)
+                if run:
+                    run = os.path.expanduser(run)
+                else:
+                    run = key
+                web = app.get("web", None)
+                if web:
+                    run = self.browser + " " + web
+                icon = app.get("icon", key)
+                icon = os.path.expanduser(icon)
+                entries[key] = Entry(name, icon, run)
+                app = key
+            keys.append(app)
+        return keys, entries
+
+    def poll_config(self):
+        try:
+            mtime = os.stat(self.config).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self.config_mtime:
+            self.config_mtime = mtime
+            self.reload()
+
+    def reload(self):
+        # apply a changed config in place, redoing only what it touches
+        timings = []
+        start = time.perf_counter()
+
+        def mark(name):
+            nonlocal start
+            now = time.perf_counter()
+            timings.append("{} {:.0f} ms".format(name, (now - start) * 1000))
+            start = now
+
+        try:
+            with open(self.config, "r") as f:
+                cfg = yaml.safe_load(f)
+            cfg["apps"]
+        except (OSError, yaml.YAMLError, TypeError, KeyError) as e:
+            print("Config: not reloaded,", e)
+            return
+        old, self.cfg = self.cfg, cfg
+        for key in ("resolution", "render_scale", "fullscreen"):
+            if cfg.get(key) != old.get(key):
+                print("Config: {} takes effect after a restart".format(key))
+        self.browser = cfg.get("browser", None)
+        self.fps = cfg.get("fps", 60)
+        self.launch_display = cfg.get("launch_display", "hide")
+        self.fade_time = cfg.get("background_fade", 1.0)
+        self.anim_time = cfg.get("animation_time", 0.15)
+        self.output.smooth = cfg.get("render_smooth", False)
+        mark("parse")
+
+        # a new theme or icon size invalidates every icon
+        theme = cfg.get("theme", None)
+        icon_sz = self.config_icon_size(cfg)
+        if theme != self.theme or icon_sz != self.icon_sz:
+            if theme != self.theme:
+                self.theme = theme
+                self.icon_index = IconIndex(theme)
+            self.icon_sz = icon_sz
+            w, h = icon_sz
+            self.selector_sz = ivec2(w + self.border.x // 6, h + self.border.y // 4 + self.border.y)
+            self.selector = self.draw_selector(self.selector_sz)
+            self.placeholder = self.draw_selector(icon_sz, DARK_GRAY[:3])
+            # results in flight have the old size
+            self.loading.clear()
+            for entry in self.apps.values():
+                if entry:
+                    self.icons.drop(entry)
+                    entry.pending = entry.failed = False
+        mark("icons")
+
+        # keep the entries (and icons) of custom apps that didn't change;
+        # stems are looked up in the catalog again as pages need them
+        keys, entries = self.config_apps(cfg["apps"])
+        changed = 0
+        for key, entry in entries.items():
+            kept = self.config_entries.get(key)
+            if kept and (kept.name, kept.icon_fn, kept.run) == (entry.name, entry.icon_fn, entry.run):
+                entries[key] = kept
+            else:
+                changed += 1
+        for key in self.config_entries.keys() - entries.keys():
+            del self.apps[key]
+        self.apps.update(entries)
+        self.config_entries = entries
+        if self.browsing:
+            home, selection = self.browsing
+            self.browsing = (keys, self.reselect(home, keys, selection))
+            self.ensure_pages()
+            self.invalidate_pages()
+        else:
+            self.my_apps, selection = keys, self.reselect(self.my_apps, keys, self.selection)
+            self.relist(selection)
+        mark("apps")
+
+        backgrounds = cfg.get("background") or []
+        if isinstance(backgrounds, str):
+            backgrounds = [backgrounds]
+        backgrounds = [os.path.expanduser(fn) for fn in backgrounds]
+        blur = cfg.get("background_blur", 8)
+        if backgrounds != self.backgrounds or blur != self.blur:
+            self.backgrounds = backgrounds
+            self.blur = blur
+            self.background_future = None
+            if backgrounds:
+                # crossfades in once ready, like a rotation
+                self.background_index = -1
+                self.next_background()
+            else:
+                self.background = None
+                self.invalidate_pages()
+        pygame.time.set_timer(
+            BACKGROUND_EVENT,
+            int(cfg.get("background_interval", 300) * 1000) if len(self.backgrounds) > 1 else 0,
         )
-        buf = im.tobytes()
-        return pygame.image.fromstring(buf, sz, "RGBA").convert_alpha()
+        mark("background")
+
+        print("Config reloaded: {}; {} apps, {} changed".format(", ".join(timings), len(keys), changed))
+
+    def reselect(self, old, new, selection):
+        # stay on the same app if it's still there
+        try:
+            return new.index(old[selection])
+        except (IndexError, ValueError):
+            return max(0, min(selection, len(new) - 1))
+
+    def entry(self, i):
+        # desktop entries are looked up in the catalog once they're needed
+        try:
+            key = self.my_apps[i]
+        except IndexError:
+            return None
+        try:
+            return self.apps[key]
+        except KeyError:
+            pass
+        entry = self.apps[key] = self.catalog.get(key)
+        if not entry:
+            print("No desktop entry for", key)
+        return entry
+
+    def visible_entries(self):
+        return {id(self.apps.get(self.my_apps[i])) for i in self.page_range(self.page)}
+
+    def memory(self):
+        # approximate resident bytes per subsystem
+        res = self.screen.get_width() * self.screen.get_height()
+        background = self.background.get_bytesize() * res if self.background else 0
+        layers = sum(page.get_bytesize() * res for page in self.pages.values())
+        search = 0
+        if self.search:
+            search = sizeof(self.search.__dict__) + sizeof(self.search_t9.__dict__)
+        rows = [
+            ("catalog", sizeof(self.catalog.dirs) + sizeof(self.catalog.files)),
+            ("apps", sizeof(self.apps)),
+            ("search", search),
+            ("icons", self.icons.bytes),
+            ("text cache", self.text.bytes),
+            ("background", background),
+            ("page layers", layers),
+            ("render target", 0 if self.screen is self.display else self.screen.get_bytesize() * res),
+        ]
+        return rows
+
+    def memory_report(self):
+        rows = self.memory()
+        lines = ["{:13} {:8} KB".format(name, n // 1024) for name, n in rows]
+        lines.append("{:13} {:8} KB".format("total", sum(n for name, n in rows) // 1024))
+        lines.append(self.icons.stats())
+        return "\n".join(lines)
+
+    def page_count(self):
+        return max(1, -(-len(self.my_apps) // self.per_page))
+
+    def page_range(self, page):
+        return range(
+            page * self.per_page, min(len(self.my_apps), (page + 1) * self.per_page)
+        )
+
+    def ensure_pages(self):
+        # layers and icons are only kept for the visible page and the ones
+        # next to it, so memory doesn't grow with the number of apps
+        resident = [self.page]
+        resident += [p for p in (self.page + 1, self.page - 1) if 0 <= p < self.page_count()]
+        for page in list(self.pages):
+            if page not in resident:
+                del self.pages[page]
+                self.page_damage.pop(page, None)
+        for page in resident:
+            if page not in self.pages:
+                self.pages[page] = pygame.Surface(self.res).convert()
+                self.invalidate_page(page=page)
+
+        wanted = set()
+        for page in resident:
+            for i in self.page_range(page):
+                entry = self.entry(i)
+                if entry:
+                    wanted.add(id(entry))
+                    if not entry.icon and not entry.pending and not entry.failed:
+                        self.load(entry)
+        for entry in self.icons.loaded():
+            if id(entry) not in wanted:
+                self.icons.drop(entry)
+        self.catalog.save()
+
+    def flip_page(self, page):
+        # a crossfade in progress ends, the layer it was fading stays opaque
+        self.end_fade()
+        old, self.page = self.page, page
+        self.ensure_pages()
+        self.anim.stop("selector")
+        if self.anim_time > 0 and abs(page - old) == 1 and old in self.pages:
+            # the neighbour's layer is resident, slide it out and this one in
+            self.slide_from, self.slide_dir = old, page - old
+            self.anim.start("slide", 0.0, 1.0, self.anim_time * 2, self.screen.get_rect)
+            self.anim.start(
+                "focus", 0.0, 1.0, self.anim_time, lambda: self.focus_rect(self.selection)
+            )
+        self.invalidate()
 
     def load(self, entry):
-        icon_fn = entry.icon_fn = os.path.expanduser(entry.icon_fn)
+        icon_fn = entry.icon_fn = os.path.expanduser(entry.icon_fn or "")
         if not icon_fn:
+            entry.failed = True
             return None
+        future = self.pool.submit(self.load_icon, entry.name, icon_fn, self.icon_sz)
+        self.loading[future] = entry
+        entry.pending = True
+        future.add_done_callback(lambda f: wake(LOAD_EVENT))
+        return future
+
+    # runs on the icon loader threads
+    def load_icon(self, name, icon_fn, sz):
         try:
-            fn = xdg.IconTheme.getIconPath(icon_fn, self.icon_sz[0], self.theme)
+            fn = self.icon_index.lookup(icon_fn, sz[0])
             # print(fn)
             if not fn:
                 # fn = '/usr/share/icons/Faenza/apps/96/' + icon_fn + '.png'
                 fn = "/usr/share/icons/Faenza/apps/scalable/" + icon_fn + ".svg"
                 # fn = xdg.IconTheme.getIconPath(icon_fn, self.icon_sz[0], 'Adwaita')
         except TypeError:
-            print("Type Error when loading", entry.name)
+            print("Type Error when loading", name)
             return None
         # print('icon fn:', fn)
         if fn.endswith(".svg"):
-            icon = self.load_svg(fn, self.icon_sz)
+            return self.rasterize(render_svg, fn, sz)
         elif fn.endswith(".png"):
             # icon = pygame.image.load(fn).convert_alpha()
-            im = Image.open(fn)
-            im = im.resize(tuple(self.icon_sz), Image.ANTIALIAS)
-            buf = im.tobytes()
-            icon = pygame.image.fromstring(buf, self.icon_sz, "RGBA").convert_alpha()
+            return self.rasterize(render_png, fn, sz)
             # icon = pygame.transform.scale(icon, self.icon_sz)
-        else:
-            return None
-        entry.icon = icon
-        return icon
+        return None
+
+    # runs on the icon loader threads
+    def load_status_icon(self, icon, sz):
+        fn = self.icon_index.lookup(icon, sz[0])
+        if not fn:
+            for category in ("status", "devices"):
+                fn = "/usr/share/icons/Faenza/{}/scalable/{}.svg".format(category, icon)
+                if os.path.exists(fn):
+                    break
+            else:
+                return None
+        if fn.endswith(".png"):
+            return self.rasterize(render_png, fn, sz)
+        return self.rasterize(render_svg, fn, sz)
+
+    def poll_icons(self):
+        if not self.loading:
+            return
+        for future in [f for f in self.loading if f.done()]:
+            entry = self.loading.pop(future)
+            try:
+                buf = future.result()
+            except Exception as e:
+                print("Failed to load icon for", entry.name + ":", e)
+                buf = None
+            entry.pending = False
+            if not buf:
+                entry.failed = True
+                continue
+            self.icons.add(entry, self.upload(buf, self.icon_sz))
+            self.invalidate_app(entry)
+        if not self.loading and not self.icons_loaded:
+            # once, for the icons queued at startup
+            self.icons_loaded = True
+            if self.icon_index.rebuilt:
+                print("Icon index: rebuilt for theme", self.icon_index.theme)
+            print(
+                "Icons loaded: {:.0f} ms, icon cache: {} hits, {} misses".format(
+                    (time.perf_counter() - self.start_time) * 1000,
+                    self.icon_cache.hits,
+                    self.icon_cache.misses,
+                )
+            )
 
     def write(
         self,
@@ -358,88 +2309,295 @@ class Homescreen:
     ):
         pos = ivec2(*pos)
 
-        if underline:
-            self.font.set_underline(True)
-
-        # shadow
-        textbuf = self.font.render(text, True, shadow)
-        # page.set_alpha(None)
-        
-        page.blit(
-            textbuf,
-            pos
-            + ivec2(-textbuf.get_rect()[2] // 2 + shadow_offset[0], shadow_offset[1]),
+        surface, origin, w = self.text.get(
+            text, self.font_size, color, shadow, shadow_offset, underline
         )
-
-        # text
-        textbuf = self.font.render(text, True, color)
-        page.blit(textbuf, pos + ivec2(-textbuf.get_rect()[2] // 2, 0))
-
-        if underline:
-            self.font.set_underline(False)
+        # page.set_alpha(None)
+        page.blit(surface, pos + ivec2(-w // 2, 0) - origin)
 
     def move(self, arrows):
+        if not self.my_apps:
+            return
+        selection = self.selection
         if arrows[0]:
             self.selection = max(0, self.selection - 1)
-            self.dirty = True
         if arrows[1]:
             self.selection = min(len(self.my_apps) - 1, self.selection + 1)
-            self.dirty = True
         if arrows[2]:
             self.selection = self.selection - min(self.selection, self.grid[0])
-            self.dirty = True
         if arrows[3]:
             self.selection = min(self.selection + self.grid[0], len(self.my_apps) - 1)
-            self.dirty = True
-
-    def builtin(self, app):
-        if app == "desktop":
-            self.done = True
-        else:
+        if self.selection != selection:
+            self.reselect_tiles(selection)
+        if self.selection // self.per_page != self.page:
+            self.traced()
+            self.flip_page(self.selection // self.per_page)
+        elif self.selection != selection:
+            self.traced()
+            self.invalidate(self.focus_rect(selection))
+            if self.anim_time > 0:
+                # on from wherever the selector is now, should it still be moving
+                target = vec2(self.selector_rect(self.selection).topleft)
+                pos = self.anim.value("selector", vec2(self.selector_rect(selection).topleft))
+                self.anim.start("selector", pos, target, self.anim_time, self.selector_region)
+                self.anim.start(
+                    "focus", 0.0, 1.0, self.anim_time, lambda: self.focus_rect(self.selection)
+                )
+            else:
+                self.invalidate(self.focus_rect(self.selection))
+
+    def reselect_tiles(self, old):
+        # the selected tile is left out of its layer and drawn over the
+        # selector by draw(), so both tiles' layers need redrawing
+        for i in (old, self.selection):
+            page = i // self.per_page
+            if page in self.pages:
+                self.invalidate_page(self.tile_rect(i), page)
+
+    def traced(self):
+        # the next frame shown reflects the input being handled
+        if self.input:
+            self.latency.input(*self.input)
+            self.input = None
+
+    def select(self):
+        entry = self.entry(self.selection)
+        if not entry:
+            return
+        self.run = entry.run
+        self.launch(self.run)
+
+    def launch(self, run):
+        # builtins by name, anything else is started as an external app
+        self.launched = run
+        handler = self.commands.get(run)
+        if handler:
+            handler()
+        elif run.startswith("@"):
             print("Not yet implemented")
             self.done = True
+        else:
+            self.spawn(run)
+
+    def exit(self):
+        self.done = True
+
+    # keypad letters, so a remote's number keys can type
+    T9 = str.maketrans("abcdefghijklmnopqrstuvwxyz", "22233344455566677778889999")
+
+    def browse(self):
+        # @apps: every installed app in the grid, filtered by type-ahead
+        if not self.search:
+            recs = sorted(
+                (
+                    (rec[1].lower(), stem, rec)
+                    for stem, rec in self.catalog.records().items()
+                    if not rec[6]
+                ),
+                key=lambda r: r[0],
+            )
+            self.catalog.save()
+            docs = []
+            for name, stem, rec in recs:
+                terms = name.split() + rec[4].split()
+                terms += [w for k in rec[5] for w in k.split()]
+                if rec[2]:
+                    terms.append(os.path.basename(rec[2].split()[0]))
+                docs.append(terms)
+            self.search_keys = [stem for name, stem, rec in recs]
+            self.search = SearchIndex(docs)
+            self.search_t9 = SearchIndex(
+                [[t.lower().translate(self.T9) for t in doc] for doc in docs]
+            )
+        self.browsing = (self.my_apps, self.selection)
+        self.filter("")
+
+    def filter(self, query):
+        self.query = query
+        # digits from a remote match letters on the same key
+        index = self.search_t9 if query.isdigit() else self.search
+        ids = index.search(query)
+        if ids is None:
+            self.my_apps = list(self.search_keys)
+        else:
+            self.my_apps = [self.search_keys[i] for i in ids]
+        self.relist(0)
+
+    def leave(self):
+        self.my_apps, selection = self.browsing
+        self.browsing = None
+        self.query = ""
+        self.relist(selection)
+
+    def relist(self, selection):
+        # the grid shows a different list, every resident layer is stale;
+        # the surfaces are kept and redrawn, only a change in the pages
+        # resident allocates or frees one
+        self.selection = selection
+        self.page = selection // self.per_page
+        stale = set(self.pages)
+        self.page_damage.clear()
+        self.anim.stop("slide")
+        self.anim.stop("selector")
+        self.ensure_pages()
+        for page in stale & self.pages.keys():
+            self.invalidate_page(page=page)
+        self.invalidate(self.query_rect)
+        if self.browsing:
+            self.query_rect = self.text_rect(self.query_text(), self.query_pos)
+        self.invalidate()
+
+    def query_text(self):
+        return "Search: " + self.query if self.query else "Type to search"
+
+    def type(self, char):
+        self.traced()
+        if char is None:
+            self.filter(self.query[:-1])
+        elif len(self.query) < 32:
+            self.filter(self.query + char)
+
+    def spawn(self, run):
+        try:
+            self.child = self.launcher(run)
+        except (OSError, ValueError) as e:
+            print("Failed to launch", run + ":", e)
+            return
+        self.save_frame()
+        self.hide_display()
+
+    def hide_display(self):
+        mode = self.launch_display
+        if mode == "hide" and not pygame.display.iconify():
+            mode = "quit"
+        if mode == "quit":
+            pygame.mouse.set_visible(True)
+            pygame.display.quit()
+        self.display_state = mode
+
+    def restore_display(self):
+        if self.display_state == "quit":
+            self.set_mode()
+            pygame.mouse.set_visible(False)
+            # layers were converted for the old display
+            self.invalidate_pages()
+        elif self.display_state == "hide":
+            try:
+                from pygame._sdl2.video import Window
+
+                Window.from_display_module().restore()
+            except (ImportError, AttributeError, pygame.error):
+                self.set_mode()
+            self.invalidate()
+        self.display_state = None
+
+    def returned(self, code):
+        child = self.child
+        self.child = None
+        self.restore_display()
+        print("{} exited ({}) after {:.1f} s".format(child.cmd, code, child.elapsed()))
+        self.return_time = time.perf_counter()
+
+    def schedule_clock(self):
+        # wake up right after the next minute boundary
+        now = self.clock.now()
+        ms = (60 - now.second) * 1000 - now.microsecond // 1000
+        pygame.time.set_timer(CLOCK_EVENT, ms + 10, loops=1)
+
+    def next_cec(self):
+        ev = self.cec.next()
+        if ev and self.recorder:
+            self.recorder.cec(ev)
+        return ev
+
+    def update(self, dt, events=None):
+        if events is None:
+            events = pygame.event.get()
+            self.dequeued = time.perf_counter()
+        if self.recorder:
+            self.recorder.begin(self.clock.elapsed(), events)
+
+        self.poll_icons()
+        self.poll_background()
+        self.poll_tray()
 
-    def update(self, dt):
-        self.dirty = True
-        
         self.run = None
         # date = subprocess.check_output(['date', '+%l:%M %p'])[:-1]
-        date = datetime.datetime.now().strftime("%l:%M %p")
+        date = self.clock.now().strftime("%l:%M %p")
         if self.last_date != date:
-            self.last_date = date
-            self.dirty = True
+            self.last_date = self.date = date
+            self.invalidate(self.date_rect)
+            self.date_rect = self.text_rect(date, self.date_pos)
+            self.invalidate(self.date_rect)
+            self.schedule_clock()
+
+        if self.child:
+            # an app is running, input is meant for it
+            for ev in events:
+                if ev.type == LAUNCH_EVENT:
+                    self.returned(ev.code)
+                elif ev.type == pygame.QUIT:
+                    self.done = True
+            while self.next_cec():
+                pass
+            return not self.done
+
+        self.handle_cec()
+        self.handle_events(events)
 
-        if self.cec.buttons:
+        if self.done:
+            return False
+
+        return True
+
+    def handle_cec(self):
+        while not self.run and not self.done:
+            ev = self.next_cec()
+            if not ev:
+                break
+            self.cec.handled(ev)
+            if ev.kind == "release":
+                continue
+            self.input = ("cec", ev.time)
             self.move(
                 (
-                    b"left" in self.cec.buttons,
-                    b"right" in self.cec.buttons,
-                    b"up" in self.cec.buttons,
-                    b"down" in self.cec.buttons,
+                    ev.key == "left",
+                    ev.key == "right",
+                    ev.key == "up",
+                    ev.key == "down",
                 )
             )
-
-            for btn in self.cec.buttons:
-                if btn == b"back":
-                    self.done = True
-                    return False
-                if btn == b"exit":
-                    self.done = True
-                    return False
-                if btn == b"select":
-                    self.run = self.apps[self.my_apps[self.selection]].run
-                    if self.run.startswith("@"):
-                        self.builtin(self.run[1:])
-                    return False
-            self.cec.buttons.clear()
-
+            if ev.kind == "repeat":
+                continue
+            if self.browsing and (ev.key == "back" or ev.key == "exit"):
+                self.leave()
+            elif ev.key == "back" or ev.key == "exit":
+                self.done = True
+            elif ev.key == "select":
+                self.select()
+            elif self.browsing and ev.key.isdigit():
+                self.type(ev.key)
+            elif self.browsing and ev.key == "clear":
+                self.type(None)
+
+    def handle_events(self, events):
         joy_move = defaultdict(lambda: False)
-        if not self.run or not self.done:
-            for ev in pygame.event.get():
+        # when the events left the queue, so a slow update() counts too
+        stamp = self.dequeued or time.perf_counter()
+        self.dequeued = None
+        if not self.run and not self.done:
+            for ev in events:
                 if ev.type == pygame.QUIT:
                     self.done = True
                     break
+                elif ev.type == BACKGROUND_EVENT:
+                    self.next_background()
+                elif ev.type == DUMP_EVENT:
+                    print(self.memory_report() if ev.what == "memory" else self.latency.dump())
+                elif ev.type == CONFIG_EVENT:
+                    self.poll_config()
                 elif ev.type == pygame.KEYDOWN:
+                    self.input = ("key", stamp)
                     self.move(
                         (
                             ev.key == pygame.K_LEFT,
@@ -449,14 +2607,30 @@ class Homescreen:
                         )
                     )
                     if ev.key == pygame.K_ESCAPE:
+                        if self.browsing:
+                            self.leave()
+                            continue
                         self.done = True
                         break
                     if ev.key == pygame.K_RETURN:
-                        self.run = self.apps[self.my_apps[self.selection]].run
-                        if self.run.startswith("@"):
-                            self.builtin(self.run[1:])
+                        self.select()
                         break
+                    if ev.key == pygame.K_F3:
+                        self.toggle_profiler()
+                        continue
+                    if ev.key == pygame.K_F4:
+                        print(self.latency.dump())
+                        continue
+                    if ev.key == pygame.K_F5:
+                        print(self.memory_report())
+                        continue
+                    if self.browsing:
+                        if ev.key == pygame.K_BACKSPACE:
+                            self.type(None)
+                        elif ev.unicode and ev.unicode.isprintable():
+                            self.type(ev.unicode)
                 elif ev.type == pygame.JOYAXISMOTION:  # pygame.JOYHATMOTION):
+                    self.input = ("joy", stamp)
                     threshold = 0.75
                     # axis = ev.axis % 2
                     axis = ev.axis
@@ -484,120 +2658,409 @@ class Homescreen:
                     else:
                         self.joy_axis[axis] = 0
                 elif ev.type == pygame.JOYBUTTONDOWN:
-                    self.run = self.apps[self.my_apps[self.selection]].run
-                    if self.run.startswith("@"):
-                        self.builtin(self.run[1:])
+                    self.select()
                     break
 
-        if self.done:
-            return False
+    def tile_pos(self, i):
+        w, h = self.icon_sz
+        padding = self.res / 6
+        icon_entry_sz = ivec2(
+            self.selector_sz[0] + w + padding[0],
+            self.selector_sz[1] + h + padding[1]
+        )
 
-        if self.run:
-            pygame.mouse.set_visible(True)
-            pygame.display.quit()
-            params = filter(lambda x: not x.startswith("%"), self.run.split())
-            try:
-                subprocess.check_call(params)
-            except subprocess.CalledProcessError:
-                pass
-            self.screen = pygame.display.set_mode(
-                self.res, self.flags
+        screen_mid = ivec2(self.res[0] // 2, self.res[1] // 2)
+        i %= self.per_page
+        x_idx = (i % self.grid[0])
+        y_idx = (i // self.grid[0])
+        x_ofs = x_idx*icon_entry_sz.x // 2
+        y_ofs = y_idx*icon_entry_sz.y // 2
+        x = screen_mid.x + x_ofs
+        y = screen_mid.y + y_ofs
+
+        x -= self.grid[0] * icon_entry_sz.x//4 - padding[0]//4
+        y -= self.grid[1] * icon_entry_sz.y//4
+
+        y += self.panel_sz[1] // 2
+        return ivec2(x, y)
+
+    def label_pos(self, pos):
+        w, h = self.icon_sz
+        return ivec2(w // 2 + pos.x, pos.y + h + int(16 * self.scale))
+
+    def selector_rect(self, i):
+        x, y = self.tile_pos(i)
+        w, h = self.icon_sz
+        return pygame.Rect(
+            x + (w - self.selector_sz[0]) // 2,
+            y + (h - self.selector_sz[1]) // 2 + self.border.y//2,
+            self.selector_sz[0],
+            self.selector_sz[1],
+        )
+
+    def focus_rect(self, i):
+        # selector and the icon grown to FOCUS
+        pos = self.tile_pos(i)
+        grow = ivec2(vec2(self.icon_sz) * (self.FOCUS - 1)) // 2 + 1
+        icon = pygame.Rect(tuple(pos - grow), tuple(self.icon_sz + grow * 2))
+        return self.selector_rect(i).union(icon)
+
+    def selector_region(self):
+        # where the moving selector is now, and where it was last drawn
+        rect = pygame.Rect(
+            tuple(ivec2(self.anim.value("selector", vec2(self.selector_rect(self.selection).topleft)))),
+            tuple(self.selector_sz),
+        )
+        return rect.union(self.selector_drawn) if self.selector_drawn else rect
+
+    def text_rect(self, text, pos, shadow_offset=ivec2(1, 1)):
+        # area covered by write(), shadow included
+        w, h = self.font.size(text)
+        rect = pygame.Rect(pos[0] + (-w // 2), pos[1], w, h)
+        return rect.union(rect.move(*shadow_offset))
+
+    def tile_rect(self, i):
+        pos = self.tile_pos(i)
+        rect = self.selector_rect(i).union(pygame.Rect(tuple(pos), tuple(self.icon_sz)))
+        app = self.entry(i)
+        if not app:
+            return rect
+        return rect.union(self.text_rect(app.name, self.label_pos(pos)))
+
+    def invalidate(self, rect=None):
+        if rect is None:
+            rect = self.screen.get_rect()
+        self.damage.append(pygame.Rect(rect))
+
+    def invalidate_page(self, rect=None, page=None):
+        if page is None:
+            page = self.page
+        if rect is None:
+            rect = self.screen.get_rect()
+        self.page_damage[page].append(pygame.Rect(rect))
+        if page == self.page:
+            self.invalidate(rect)
+
+    def invalidate_pages(self):
+        # display format or layout changed, rebuild every static layer
+        for page in self.pages:
+            self.pages[page] = pygame.Surface(self.res).convert()
+            self.invalidate_page(page=page)
+
+    def invalidate_app(self, entry):
+        for page in self.pages:
+            for i in self.page_range(page):
+                if self.apps.get(self.my_apps[i]) is entry:
+                    self.invalidate_page(self.tile_rect(i), page)
+
+    def draw_tile(self, surface, i, app, offset=ivec2(0, 0), focus=0.0):
+        pos = self.tile_pos(i) + offset
+        if app.icon:
+            # img = pygame.transform.scale(app.icon, ivec2(w - t, h - t))
+            icon = self.focused(app.icon, focus) if focus else app.icon
+            grow = (ivec2(icon.get_size()) - self.icon_sz) // 2
+            surface.blit(icon, tuple(pos - grow), special_flags=PREMULTIPLIED)
+            self.icons.touch(app)
+            self.write(surface, app.name, self.label_pos(pos))
+        elif app.pending:
+            surface.blit(self.placeholder, tuple(pos), special_flags=PREMULTIPLIED)
+            self.write(surface, app.name, self.label_pos(pos))
+
+    # the selected icon is drawn this much larger
+    FOCUS = 1.1
+
+    def focused(self, icon, focus):
+        # scaled every frame while growing, cached once it's at FOCUS
+        sz = ivec2(vec2(self.icon_sz) * (1 + (self.FOCUS - 1) * focus))
+        if sz == self.icon_sz:
+            return icon
+        if focus < 1:
+            return pygame.transform.smoothscale(icon, tuple(sz))
+        if not self.focus_icon or self.focus_icon[0] is not icon:
+            self.focus_icon = (icon, pygame.transform.smoothscale(icon, tuple(sz)))
+        return self.focus_icon[1]
+
+    def draw_background(self, page, rect):
+        if self.background:
+            page.blit(self.background, rect, rect)
+        else:
+            page.fill(BLACK, rect)
+
+    def draw_page(self, index, rect):
+        # static layer, blits outside the clip rect are free
+        page = self.pages[index]
+        page.set_clip(rect)
+        self.draw_background(page, rect)
+        page.blit(
+            self.panel, (0, -self.panel_sz[1] // 2), special_flags=PREMULTIPLIED
+        )
+
+        for i in self.page_range(index):
+            app = self.entry(i)
+            if app and i != self.selection and rect.colliderect(self.tile_rect(i)):
+                self.draw_tile(page, i, app)
+
+        # page dots
+        count = self.page_count()
+        if count > 1:
+            r = self.res[1] // 180
+            y = self.res[1] - r * 6
+            for p in range(count):
+                x = self.res[0] // 2 + (p * 2 - count + 1) * r * 2
+                pygame.draw.circle(page, WHITE if p == index else DARK_GRAY, (x, y), r)
+        page.set_clip(None)
+
+    def draw(self, rect):
+        # dynamic layers on top of the static one, constant blit count
+        self.screen.set_clip(rect)
+        offset = ivec2(0, 0)
+        slide = self.anim.value("slide")
+        if slide is not None and self.slide_from in self.pages:
+            # old layer out one side, the current one in from the other
+            x = int(slide * self.res[0])
+            self.screen.blit(self.pages[self.slide_from], (-self.slide_dir * x, 0))
+            offset = ivec2(self.slide_dir * (self.res[0] - x), 0)
+            self.screen.blit(self.pages[self.page], tuple(offset))
+        else:
+            if self.fade_from:
+                self.screen.blit(self.fade_from, rect, rect)
+            self.screen.blit(self.pages[self.page], rect, rect)
+
+        i = self.selection
+        app = self.entry(i)
+        if app:
+            pos = self.anim.value("selector", vec2(self.selector_rect(i).topleft))
+            sel = pygame.Rect(tuple(ivec2(pos) + offset), tuple(self.selector_sz))
+            if rect.colliderect(sel):
+                self.screen.blit(self.selector, sel, special_flags=PREMULTIPLIED)
+                self.selector_drawn = sel
+            if rect.colliderect(self.focus_rect(i).move(*offset)):
+                self.draw_tile(self.screen, i, app, offset, self.anim.value("focus", 1.0))
+
+        if self.date and rect.colliderect(self.date_rect):
+            self.write(self.screen, self.date, self.date_pos)
+
+        if self.browsing and rect.colliderect(self.query_rect):
+            self.write(self.screen, self.query_text(), self.query_pos)
+
+        for i, icon in enumerate(self.tray_shown[::-1]):
+            self.screen.blit(
+                icon,
+                (self.res[0] - ((i + 1) * self.tray_sz[0]) - i * 12 - 24, 2),
+                special_flags=PREMULTIPLIED,
             )
-            pygame.mouse.set_visible(False)
-            self.dirty = True
-            return False
-        
-        return True
 
-    def render(self):
-        if self.dirty:
-            page = self.pages[self.page]
+        if self.hud and rect.colliderect(self.hud_rect):
+            self.screen.blit(self.hud, self.hud_rect)
+        self.screen.set_clip(None)
+
+    def idle_work(self):
+        # deferred startup first, then the neighbouring pages
+        if self.deferred and self.first_frame:
+            self.run_deferred()
+            return True
+        return self.prerender()
+
+    def prerender(self):
+        # build a neighbouring page's layer ahead of time, one per call
+        for page in list(self.page_damage):
+            if page != self.page and page in self.pages:
+                for rect in merge_rects(self.page_damage.pop(page)):
+                    self.draw_page(page, rect)
+                return True
+        return False
+
+    def fade(self):
+        page = self.pages[self.page]
+        t = (self.clock.elapsed() - self.fade_start) / max(self.fade_time, 0.001)
+        if t >= 1:
+            self.end_fade()
+        else:
+            if self.fade_layer is not page:
+                # another layer is showing now, don't leave the old one translucent
+                if self.fade_layer:
+                    self.fade_layer.set_alpha(None)
+                self.fade_layer = page
+            page.set_alpha(int(t * 255))
+        self.invalidate()
+
+    def end_fade(self):
+        if self.fade_layer:
+            self.fade_layer.set_alpha(None)
+        self.fade_from = self.fade_layer = None
 
-            # self.screen.fill(BLACK)
-            w, h = self.icon_sz
-            padding = self.res / 6
-            
-            self.screen.blit(self.background, (0, 0))
+    def render(self):
+        if self.display_state:
+            return
+
+        if self.fade_from:
+            self.fade()
+        if self.anim.tweens:
+            self.animate()
+        # the loop only polls at fps while something moves
+        self.animating = bool(self.fade_from or self.anim.tweens)
+
+        damage = self.page_damage.pop(self.page, None)
+        if damage:
+            for rect in merge_rects(damage):
+                self.draw_page(self.page, rect)
+        if "slide" in self.anim.tweens and self.slide_from in self.pages:
+            # the layer sliding out gets its old selected tile back first
+            for rect in merge_rects(self.page_damage.pop(self.slide_from, [])):
+                self.draw_page(self.slide_from, rect)
+
+        if not self.damage:
+            return
+
+        if self.profiler:
+            self.draw_hud()
+
+        screen_rect = self.screen.get_rect()
+        rects = merge_rects(
+            [r.clip(screen_rect) for r in self.damage if r.colliderect(screen_rect)]
+        )
+        self.damage = []
 
-            page.fill((0,0,0,0))
-            page.blit(self.panel, (0, -self.panel_sz[1] // 2))
+        for rect in rects:
+            self.draw(rect)
+            self.pixels += rect.w * rect.h
 
-            self.write(page, self.date, ivec2(self.res[0] / 2, 8))
+        # page.set_alpha(128)
+        # page = pygame.transform.scale(page, ivec2(self.res[0] - t, self.res[1] - t))
+        self.present(rects)
 
-            for i, icon in enumerate(self.tray[::-1]):
-                page.blit(
-                    icon,
-                    (self.res[0] - ((i + 1) * self.tray_sz[0]) - i * 12 - 24, 2),
+        if self.return_time:
+            print(
+                "Back on screen: {:.0f} ms".format(
+                    (time.perf_counter() - self.return_time) * 1000
                 )
+            )
+            self.return_time = None
 
-            for i in range(len(self.my_apps)):
-                if i < 0:
-                    continue
-                try:
-                    app = self.apps[self.my_apps[i]]
-                except KeyError:
-                    break
-                except IndexError:
-                    break
-
-                icon_entry_sz = ivec2(
-                    self.selector_sz[0] + w + padding[0],
-                    self.selector_sz[1] + h + padding[1]
+        if not self.first_frame:
+            self.first_frame = True
+            print(
+                "First frame: {:.0f} ms".format(
+                    (time.perf_counter() - self.start_time) * 1000
                 )
+            )
 
-                screen_mid = ivec2(self.res[0] // 2, self.res[1] // 2)
-                x_idx = (i % self.grid[0])
-                y_idx = (i // self.grid[0])
-                x_ofs = x_idx*icon_entry_sz.x // 2
-                y_ofs = y_idx*icon_entry_sz.y // 2
-                x = screen_mid.x + x_ofs
-                y = screen_mid.y + y_ofs
+    def animate(self):
+        for rect in self.anim.step():
+            self.invalidate(rect)
 
-                x -= self.grid[0] * icon_entry_sz.x//4 - padding[0]//4
-                y -= self.grid[1] * icon_entry_sz.y//4
+    def present(self, rects):
+        pygame.display.update(self.upscale(rects))
+        self.latency.presented()
 
-                y += self.panel_sz[1] // 2
+    def upscale(self, rects):
+        return self.output.upscale(rects)
 
-                if self.selection == i:
-                    page.blit(
-                        self.selector,
-                        (
-                            x + (w - self.selector_sz[0]) // 2,
-                            y + (h - self.selector_sz[1]) // 2 + self.border.y//2,
-                            self.selector_sz[0],
-                            self.selector_sz[1],
-                        ),
-                    )
-                
-                if app.icon:
-                    ax, ay = x, y
-                    # img = pygame.transform.scale(app.icon, ivec2(w - t, h - t))
-                    page.blit(app.icon, (x, y))
-                    name = app.name
-                    self.write(page, name, ivec2(w // 2 + x, y + h + 16))
-                
-            # page.set_alpha(128)
-            # page = pygame.transform.scale(page, ivec2(self.res[0] - t, self.res[1] - t))
-            self.screen.blit(page, (0,0))
-            pygame.display.flip()
-            self.dirty = False
+    def toggle_profiler(self):
+        if self.profiler:
+            self.profiler.close()
+            self.profiler = self.hud = None
+            self.invalidate(self.hud_rect)
+        else:
+            self.profiler = Profiler(self, self.profile_log)
+
+    def draw_hud(self):
+        self.invalidate(self.hud_rect)
+        font = self.text.font(max(10, self.font_size * 2 // 3))
+        lines = self.profiler.lines()
+        h = font.get_linesize()
+        self.hud = pygame.Surface(
+            (max(font.size(line)[0] for line in lines) + 8, h * len(lines) + 8)
+        ).convert()
+        self.hud.fill(BLACK)
+        for i, line in enumerate(lines):
+            self.hud.blit(font.render(line, False, WHITE), (4, 4 + i * h))
+        self.hud_rect = self.hud.get_rect(bottomleft=(8, self.res[1] - 8))
+        self.invalidate(self.hud_rect)
+
+    def report_stats(self):
+        now = time.perf_counter()
+        elapsed = now - self.stats_time
+        if elapsed < 1:
+            return
+        cpu = time.process_time()
+        if self.debug:
+            print(
+                "Presented: {:.0f} px/s, CPU {:.1f}%, {}, {}".format(
+                    self.pixels / elapsed,
+                    (cpu - self.stats_cpu) / elapsed * 100,
+                    self.text.stats(),
+                    self.cec.stats(),
+                )
+            )
+            if self.profiler:
+                print(self.profiler.summary())
+            if self.latency.recent:
+                print(self.latency.stats())
+            if self.anim.tweens:
+                print(self.anim.stats())
+        self.pixels = 0
+        self.stats_time = now
+        self.stats_cpu = cpu
 
     def run(self):
         self.done = False
         self.last_date = None
         self.date = None
-        
-        self.t = self.dt = 0
-        
+
         while not self.done:
-            dt = self.clock.tick(60)
-            self.t += dt * 0.1
-            if not self.update(dt):
+            if self.display_state == "quit":
+                # no display and no event queue, wait on the app itself
+                try:
+                    code = self.child.proc.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    continue
+                if self.recorder:
+                    # not through update(), so log it here for replay()
+                    self.recorder.begin(
+                        self.clock.elapsed(), [pygame.event.Event(LAUNCH_EVENT, code=code)]
+                    )
+                self.returned(code)
+                continue
+            if self.animating:
+                dt = self.clock.tick(self.fps)
+                events = pygame.event.get()
+            elif self.idle_work():
+                # keep working through startup and neighbouring pages unless input comes
+                events = pygame.event.get()
+                dt = self.clock.tick()
+            else:
+                # idle: sleep until input, a finished icon or the clock timer
+                events = [pygame.event.wait(self.idle_timeout)]
+                events += pygame.event.get()
+                dt = self.clock.tick()
+            # key and joystick input is timed from here, before update() work
+            self.dequeued = time.perf_counter()
+            if self.profiler:
+                self.profiler.begin()
+            if not self.update(dt, events):
                 break
 
             self.render()
+            if self.profiler:
+                self.profiler.end()
+            self.report_stats()
                 
+        self.close()
+
+    def close(self):
+        self.save_frame()
+        self.pool.shutdown(wait=False, cancel_futures=True)
         self.cec.stop()
+        for provider in self.tray:
+            provider.stop()
+        if self.profiler:
+            # flushes the CSV log
+            self.profiler.close()
+            self.profiler = self.hud = None
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
 
 
 def prop(name, line):
@@ -608,5 +3071,67 @@ def prop(name, line):
 
 
 if __name__ == "__main__":
-    homescreen = Homescreen()
+    parser = argparse.ArgumentParser(description="Couch Mode")
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="wipe the cached icons, backgrounds and last frames, and exit",
+    )
+    parser.add_argument(
+        "--rebuild-cache",
+        action="store_true",
+        help="wipe the icon and background caches and rebuild them",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="print frame statistics every second"
+    )
+    parser.add_argument(
+        "--cec-log",
+        metavar="FILE",
+        help="replay captured cec-client output instead of running cec-client",
+    )
+    parser.add_argument(
+        "--config", metavar="FILE", default="config.yaml", help="config file to use"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        help="show the frame profiler overlay, and log frames as CSV to FILE",
+    )
+    parser.add_argument(
+        "--record", metavar="FILE", help="record every input to FILE, for --replay"
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="replay a --record log headless, print frame times and final state as JSON",
+    )
+    args = parser.parse_args()
+
+    if args.replay:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+        # status messages go to stderr, stdout is only the result
+        with contextlib.redirect_stdout(sys.stderr):
+            result = replay(args.replay, args.config)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    if args.clear_cache:
+        RasterCache().clear()
+        RasterCache(os.path.join(CACHE_DIR, "backgrounds")).clear()
+        RasterCache(os.path.join(CACHE_DIR, "frames")).clear()
+        sys.exit(0)
+
+    homescreen = Homescreen(
+        rebuild_cache=args.rebuild_cache,
+        debug=args.debug,
+        cec_log=args.cec_log,
+        config=args.config,
+        profile=args.profile is not None,
+        profile_log=args.profile,
+        record=args.record,
+    )
     homescreen.run()